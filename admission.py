@@ -0,0 +1,134 @@
+"""Admission control for w-chat, so one user or guild can't hog the bot"""
+import asyncio
+import contextlib
+import time
+
+from config import (
+    ADMISSION_WAIT, CHAT_GLOBAL_CONCURRENCY, CHAT_GUILD_BURST, CHAT_GUILD_CONCURRENCY, CHAT_GUILD_RATE,
+    CHAT_USER_BURST, CHAT_USER_QUEUE, CHAT_USER_RATE
+)
+from metrics import Gauge
+
+class AdmissionRejected(Exception):
+    """Raised when a chat request is turned away, the message is shown to the user"""
+
+class TokenBucket:
+    """Allows rate requests per minute on average, with bursts of up to capacity"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self):
+        """Seconds until a request would be allowed, 0 if it is allowed now"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+    
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+    
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class AdmissionController:
+    """Decides whether a chat request runs now, waits briefly, or is turned away.
+    
+    Requests from the same user run one at a time and in order. Each guild and the bot
+    as a whole have a cap on replies being generated at once, and users and guilds are
+    rate limited with token buckets. Anything over the limits is rejected right away
+    instead of piling up."""
+    
+    def __init__(self):
+        self.user_pending = {}  # user id -> messages being answered or waiting
+        self.user_locks = {}  # user id -> lock that serializes their requests
+        self.user_buckets = {}
+        self.guild_buckets = {}
+        self.guild_active = {}  # guild id -> replies being generated
+        self.active = 0
+        self.slot_freed = asyncio.Condition()
+    
+    def _bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            # Full buckets behave exactly like new ones, so drop them to keep memory bounded
+            if len(buckets) >= 10000:
+                for stale in [k for k, b in buckets.items() if b.is_full()]:
+                    del buckets[stale]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+    
+    def _has_slot(self, guild_id):
+        return (self.active < CHAT_GLOBAL_CONCURRENCY
+                and self.guild_active.get(guild_id, 0) < CHAT_GUILD_CONCURRENCY)
+    
+    def _check_limits(self, user_id, guild_id, message):
+        pending = self.user_pending.get(user_id, [])
+        if message in pending:
+            raise AdmissionRejected("I'm already answering that message!")
+        if len(pending) >= CHAT_USER_QUEUE:
+            raise AdmissionRejected("I'm still working on your last messages, please wait for me to finish!")
+        
+        user_bucket = self._bucket(self.user_buckets, user_id, CHAT_USER_RATE, CHAT_USER_BURST)
+        guild_bucket = self._bucket(self.guild_buckets, guild_id, CHAT_GUILD_RATE, CHAT_GUILD_BURST)
+        wait = user_bucket.wait_time()
+        if wait:
+            raise AdmissionRejected(f"You're sending messages too fast, try again in {wait:.0f}s!")
+        wait = guild_bucket.wait_time()
+        if wait:
+            raise AdmissionRejected(f"This server is sending me too many messages, try again in {wait:.0f}s!")
+        user_bucket.take()
+        guild_bucket.take()
+    
+    async def _acquire_slot(self, guild_id):
+        async with self.slot_freed:
+            if not self._has_slot(guild_id):
+                try:
+                    await asyncio.wait_for(self.slot_freed.wait_for(lambda: self._has_slot(guild_id)), ADMISSION_WAIT)
+                except asyncio.TimeoutError:
+                    raise AdmissionRejected("I'm talking to too many people right now, please try again in a moment!")
+            self.active += 1
+            self.guild_active[guild_id] = self.guild_active.get(guild_id, 0) + 1
+    
+    async def _release_slot(self, guild_id):
+        async with self.slot_freed:
+            self.active -= 1
+            self.guild_active[guild_id] -= 1
+            if not self.guild_active[guild_id]:
+                del self.guild_active[guild_id]
+            self.slot_freed.notify_all()
+    
+    @contextlib.asynccontextmanager
+    async def admit(self, user_id, guild_id, message):
+        """Hold a slot for one chat request, raises AdmissionRejected if it can't run"""
+        self._check_limits(user_id, guild_id, message)
+        pending = self.user_pending.setdefault(user_id, [])
+        pending.append(message)
+        lock = self.user_locks.setdefault(user_id, asyncio.Lock())
+        try:
+            async with lock:
+                await self._acquire_slot(guild_id)
+                try:
+                    yield
+                finally:
+                    await self._release_slot(guild_id)
+        finally:
+            pending.remove(message)
+            if not pending:
+                del self.user_pending[user_id]
+                del self.user_locks[user_id]
+
+admission = AdmissionController()
+
+Gauge("waifu_chat_active", "Chat replies being generated", function=lambda: admission.active)
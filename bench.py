@@ -0,0 +1,350 @@
+"""Offline benchmark for the chat pipeline.
+
+Runs the real `w-chat` command against fake Discord objects, a local OpenAI compatible
+server with configurable latency and a fake ElevenLabs that returns canned MP3, then
+reports throughput, end-to-end and per-stage latency, and conversation history memory.
+
+    python bench.py --users 50 --messages 5 --first-token 0.4 --token-delay 0.02
+"""
+import os
+import argparse
+import asyncio
+import itertools
+import json
+import shutil
+import threading
+import time
+import tracemalloc
+
+from aiohttp import web
+import httpx
+
+parser = argparse.ArgumentParser(description="Benchmark the Waifu.exe chat pipeline offline")
+parser.add_argument('--users', type=int, default=20, help="simulated users talking at once")
+parser.add_argument('--guilds', type=int, default=5, help="guilds the users are spread over")
+parser.add_argument('--messages', type=int, default=5, help="messages each user sends")
+parser.add_argument('--first-token', type=float, default=0.3, help="seconds before the mock model answers")
+parser.add_argument('--token-delay', type=float, default=0.01, help="seconds between streamed words")
+parser.add_argument('--reply-words', type=int, default=60, help="words in each mock reply")
+parser.add_argument('--tts-latency', type=float, default=0.25, help="seconds the fake ElevenLabs takes")
+parser.add_argument('--speech-seconds', type=float, default=1.0, help="length of the canned MP3")
+parser.add_argument('--no-voice', action='store_true', help="users are not in a voice channel")
+parser.add_argument('--realtime', action='store_true', help="play audio at real speed instead of as fast as possible")
+parser.add_argument('--no-stream', action='store_true', help="benchmark the non-streaming reply path")
+parser.add_argument('--port', type=int, default=8799, help="port for the mock OpenAI server")
+parser.add_argument('--json', action='store_true', help="print the report as JSON")
+args = parser.parse_args()
+
+# Configure the bot before importing it. Admission limits are lifted so the benchmark
+# measures the pipeline, set them explicitly to benchmark admission control instead.
+os.environ.update({
+    'DISCORD_TOKEN': 'bench',
+    'OPENAI_API_KEY': 'bench',
+    'ELEVENLABS_API_KEY': 'bench',
+    'LLM_MODELS': f"bench-model@http://127.0.0.1:{args.port}/v1",
+    'STREAM_RESPONSES': '0' if args.no_stream else '1',
+    'CONVERSATION_STORE': 'memory',
+    'TTS_CACHE_DISK_MB': '0',
+    'SUMMARIZE_HISTORY': '0',
+})
+for name, value in {
+    'CHAT_USER_QUEUE': '1000', 'CHAT_GUILD_CONCURRENCY': '1000', 'CHAT_GLOBAL_CONCURRENCY': '1000',
+    'CHAT_USER_RATE': '1000000', 'CHAT_USER_BURST': '1000000',
+    'CHAT_GUILD_RATE': '1000000', 'CHAT_GUILD_BURST': '1000000', 'ADMISSION_WAIT': '600',
+}.items():
+    os.environ.setdefault(name, value)
+
+tracemalloc.start()
+import bot  # noqa: E402
+import metrics  # noqa: E402
+import store  # noqa: E402
+import tts  # noqa: E402
+import voice  # noqa: E402
+
+# Mock OpenAI compatible server
+
+WORDS = "Onii-chan, that is such a fun question! Let me think about it for a moment. " \
+        "I really love talking with you every day. Here is what I found out for you!".split()
+reply_ids = itertools.count()
+
+def mock_reply():
+    # Every reply is different so the speech cache doesn't hide the TTS cost
+    words = list(itertools.islice(itertools.cycle(WORDS), args.reply_words))
+    words[0] = f"Reply {next(reply_ids)}:"
+    return words
+
+async def chat_completions(request):
+    body = await request.json()
+    words = mock_reply()
+    await asyncio.sleep(args.first_token)
+    if not body.get('stream'):
+        await asyncio.sleep(args.token_delay * len(words))
+        return web.json_response({
+            "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": body['model'],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": " ".join(words)}}],
+        })
+
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    for i, word in enumerate(words):
+        if i:
+            await asyncio.sleep(args.token_delay)
+        chunk = {
+            "id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": body['model'],
+            "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+        }
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+async def start_mock_llm():
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+    return runner
+
+# Fake ElevenLabs returning a canned MP3
+
+MP3_FRAME_SECONDS = 1152 / 44100
+
+def canned_mp3(seconds):
+    """Silent 128kbps MPEG-1 Layer III frames, which ffmpeg decodes to silence"""
+    frame = b'\xff\xfb\x90\x64' + bytes(413)
+    return frame * max(1, round(seconds / MP3_FRAME_SECONDS))
+
+CANNED_MP3 = canned_mp3(args.speech_seconds)
+
+async def fake_elevenlabs(request):
+    await asyncio.sleep(args.tts_latency)
+    return httpx.Response(200, content=CANNED_MP3, headers={'Content-Type': 'audio/mpeg'})
+
+# Fake Discord objects
+
+class FakeMessage:
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+class FakeVoiceClient:
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.connected = True
+        self.playing = None
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.playing is not None
+
+    async def move_to(self, channel):
+        await asyncio.sleep(0.05)
+        self.channel = channel
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+    def play(self, source, after=None):
+        """Read 20ms frames in a thread like discord.py's AudioPlayer does"""
+        stopped = threading.Event()
+        self.playing = stopped
+
+        def run():
+            error = None
+            try:
+                while not stopped.is_set():
+                    data = source.read()
+                    if not data:
+                        break
+                    # Silence means the stream is waiting for speech, so wait like a real player would
+                    if args.realtime or data is voice.SpeechStream.SILENCE:
+                        time.sleep(0.02)
+            except Exception as e:
+                error = e
+            finally:
+                source.cleanup()
+                self.playing = None
+                if after:
+                    after(error)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop(self):
+        if self.playing:
+            self.playing.set()
+
+class FakeVoiceChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.name = f"voice-{guild.id}"
+
+    async def connect(self, timeout=None, reconnect=True):
+        await asyncio.sleep(0.1)
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self)
+
+class FakeAuthor:
+    def __init__(self, user_id, guild):
+        self.id = user_id
+        self.voice = None if args.no_voice else type('VoiceState', (), {'channel': guild.voice_channel})()
+
+class FakeContext:
+    def __init__(self, author, guild):
+        self.author = author
+        self.guild = guild
+        self.voice_client = guild.voice_client
+
+    async def reply(self, content=None, **kwargs):
+        return FakeMessage()
+
+    async def send(self, content=None, **kwargs):
+        return FakeMessage()
+
+class FakePCMSource:
+    """Stands in for ffmpeg when it isn't installed, 20ms of silence per read"""
+
+    def __init__(self, audio):
+        frames = len(audio) // 417 * MP3_FRAME_SECONDS
+        self.remaining = max(1, round(frames / 0.02))
+
+    def read(self):
+        if self.remaining <= 0:
+            return b''
+        self.remaining -= 1
+        return bytes(3840)
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        pass
+
+# Benchmark
+
+samples = {}  # histogram name -> raw observations
+
+def record_samples(metric):
+    observe = metric.observe
+
+    def observe_and_record(value, **labels):
+        samples.setdefault(metric.name, []).append(value)
+        observe(value, **labels)
+
+    metric.observe = observe_and_record
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+async def voice_idle():
+    """Wait until every guild has finished speaking"""
+    def busy():
+        return any(not session.queue.empty() or session.current is not None
+                   for session in voice.voice_sessions.sessions.values())
+
+    # Checked twice, a session is briefly neither queued nor current while it picks up the next utterance
+    while True:
+        while busy():
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.1)
+        if not busy():
+            return
+
+async def simulate_user(user_id, guild, latencies):
+    for i in range(args.messages):
+        ctx = FakeContext(FakeAuthor(user_id, guild), guild)
+        started = time.monotonic()
+        await bot.chat.callback(ctx, message=f"Hello waifu, this is message {i} from user {user_id}")
+        latencies.append(time.monotonic() - started)
+
+async def run():
+    runner = await start_mock_llm()
+    tts.elevenlabs_http = httpx.AsyncClient(
+        base_url="https://api.elevenlabs.io/v1",
+        transport=httpx.MockTransport(fake_elevenlabs)
+    )
+    if not shutil.which('ffmpeg'):
+        print("ffmpeg not found, playback reads synthetic PCM instead of transcoding")
+        voice.speech_audio_source = FakePCMSource
+    for metric in metrics.all_metrics:
+        if isinstance(metric, metrics.Histogram):
+            record_samples(metric)
+
+    guilds = [FakeGuild(1000 + i) for i in range(args.guilds)]
+    latencies = []
+    memory = []
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.monotonic()
+    try:
+        # Users join in waves so history memory can be read off per user count
+        waves = sorted({max(1, args.users * step // 4) for step in range(1, 5)})
+        joined = 0
+        for users in waves:
+            await asyncio.gather(*(simulate_user(user_id, guilds[user_id % len(guilds)], latencies)
+                                   for user_id in range(joined, users)))
+            joined = users
+            memory.append({
+                "users": len(store.conversation_store.conversations),
+                "history_bytes": store.conversation_store.size,
+                "traced_bytes": tracemalloc.get_traced_memory()[0] - baseline,
+            })
+        text_elapsed = time.monotonic() - started
+        await voice_idle()
+        elapsed = time.monotonic() - started
+    finally:
+        for guild in guilds:
+            await voice.voice_sessions.close(guild)
+        await runner.cleanup()
+
+    chats = len(latencies)
+    report = {
+        "chats": chats,
+        "throughput_per_second": chats / text_elapsed,
+        "elapsed_seconds": elapsed,
+        "end_to_end": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99)},
+        "stages": {name.replace('waifu_', '', 1): {"count": len(values), "p50": percentile(values, 50),
+                                                  "p99": percentile(values, 99)}
+                   for name, values in samples.items()},
+        "memory": memory,
+        "errors": {dict(labels).get('stage'): value for labels, value in metrics.ERRORS.values.items()},
+    }
+    return report
+
+def print_report(report):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}ms"
+
+    print(f"\n{report['chats']} chats in {report['elapsed_seconds']:.1f}s, "
+          f"{report['throughput_per_second']:.1f} chats/s")
+    print(f"{'stage':<28}{'count':>7}{'p50':>10}{'p99':>10}")
+    print(f"{'end to end (text)':<28}{report['chats']:>7}{ms(report['end_to_end']['p50']):>10}"
+          f"{ms(report['end_to_end']['p99']):>10}")
+    for name, stage in report['stages'].items():
+        print(f"{name:<28}{stage['count']:>7}{ms(stage['p50']):>10}{ms(stage['p99']):>10}")
+    print(f"\n{'users':>7}{'history bytes':>16}{'per user':>10}{'traced bytes':>16}")
+    for row in report['memory']:
+        print(f"{row['users']:>7}{row['history_bytes']:>16}{row['history_bytes'] // max(1, row['users']):>10}"
+              f"{row['traced_bytes']:>16}")
+    if report['errors']:
+        print(f"\nerrors: {report['errors']}")
+
+if __name__ == "__main__":
+    result = asyncio.run(run())
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
@@ -0,0 +1,245 @@
+"""The Discord bot and its commands"""
+import asyncio
+import time
+
+import discord
+from discord.ext import commands
+import openai
+
+from admission import AdmissionRejected, admission
+from chat import get_ai_response, pop_sentences, stream_ai_response
+from config import EDIT_INTERVAL, PRIORITY_HIGH, SHARD_COUNT, SHARD_IDS, STREAM_RESPONSES
+from llm import model_router
+from metrics import CHAT_REPLY, CHAT_REQUESTS, ERRORS, Gauge, startup
+from store import conversation_store, load_token_encoding, run_store
+from tasks import background_tasks
+import tts
+from voice import Utterance, voice_sessions
+from web import ADMIN_ROUTES, json_response, web_server
+
+# Only the gateway events the bot uses: guilds and voice states to talk in voice channels,
+# messages and their content for commands
+intents = discord.Intents.none()
+intents.guilds = True
+intents.voice_states = True
+intents.messages = True
+intents.message_content = True
+
+# Processes can split the shards between them with SHARD_COUNT and SHARD_IDS
+bot = commands.AutoShardedBot(command_prefix='w-', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+web_server.gateway = bot
+
+def shard_latencies():
+    return {shard_id: latency for shard_id, latency in bot.latencies if latency != float('inf')}
+
+Gauge("waifu_gateway_latency_seconds", "Heartbeat latency of each shard run by this process",
+      function=lambda: {(("shard", shard_id),): latency for shard_id, latency in shard_latencies().items()})
+
+async def handle_admin_stats(headers):
+    return json_response(200, {
+        "shards": shard_latencies(),
+        "models": model_router.stats(),
+        "tts_cache": tts.tts_cache.stats() if tts.tts_cache else None,
+        "voice_sessions": voice_sessions.active_sessions(),
+        "chat_active": admission.active,
+        "history_users": len(conversation_store.conversations),
+        "history_bytes": conversation_store.size,
+        "background_tasks": len(background_tasks),
+    })
+
+ADMIN_ROUTES['/admin/stats'] = handle_admin_stats
+
+async def start(token):
+    """Log in to Discord and run until the bot is closed"""
+    discord.utils.setup_logging()
+    async with bot:
+        try:
+            await bot.start(token)
+        except discord.errors.LoginFailure:
+            print("Error: Invalid token. Please check your DISCORD_TOKEN in .env file!")
+
+@bot.event
+async def setup_hook():
+    startup.mark("logged in")
+    # Load the tokenizer while the gateway connects, instead of on the first chat
+    asyncio.get_running_loop().run_in_executor(None, load_token_encoding)
+
+@bot.event
+async def on_ready():
+    startup.mark("ready")
+    print(f'{bot.user} has connected to Discord! (shards {bot.shard_ids or "all"} of {bot.shard_count})')
+    print('Make sure you have enabled the MESSAGE CONTENT INTENT in the Discord Developer Portal')
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    # Handle when the bot is disconnected from voice
+    if member.id == bot.user.id and before.channel and not after.channel:
+        print(f"Bot was disconnected from voice channel {before.channel.name}")
+        # Don't undo disconnects we asked for (idle timeout or w-disconnect)
+        if voice_sessions.expected_disconnect(member.guild.id):
+            return
+        # Try to reconnect if we were disconnected
+        if before.channel:
+            try:
+                await asyncio.sleep(1)  # Wait a bit before reconnecting
+                await before.channel.connect(timeout=15, reconnect=True)
+                print(f"Successfully reconnected to voice channel {before.channel.name}")
+            except Exception as e:
+                print(f"Failed to reconnect to voice channel: {e}")
+
+async def stream_chat_reply(ctx, thinking_msg, message, started):
+    """Stream the AI response into thinking_msg and speak it sentence by sentence"""
+    speech = None
+    if ctx.guild and ctx.author.voice:
+        # Queue the reply now so the bot joins voice while the model is still thinking
+        speech = Utterance(ctx.author.voice.channel, started=started)
+        voice_sessions.speak(ctx.guild, speech)
+    
+    text = ""
+    pending = ""
+    last_edit = time.monotonic()
+    try:
+        async for delta in stream_ai_response(message, ctx.author.id):
+            text += delta
+            if speech:
+                pending += delta
+                sentences, pending = pop_sentences(pending)
+                for sentence in sentences:
+                    speech.add(sentence)
+            # Rate limit edits, Discord only allows a handful per few seconds
+            if time.monotonic() - last_edit >= EDIT_INTERVAL and text.strip():
+                await thinking_msg.edit(content=f"\n```{text} ▌```")
+                last_edit = time.monotonic()
+        
+        await thinking_msg.edit(content=f"\n```{text}```")
+    finally:
+        if speech:
+            if pending.strip():
+                speech.add(pending.strip())
+            speech.close()
+
+@bot.command(name='chat')
+async def chat(ctx, *, message: str):
+    started = time.monotonic()
+    guild_id = ctx.guild.id if ctx.guild else None
+    try:
+        async with admission.admit(ctx.author.id, guild_id, message):
+            answered = await chat_reply(ctx, message, started)
+        if answered:
+            CHAT_REQUESTS.inc(outcome="answered")
+            CHAT_REPLY.observe(time.monotonic() - started)
+        else:
+            CHAT_REQUESTS.inc(outcome="error")
+    except AdmissionRejected as e:
+        CHAT_REQUESTS.inc(outcome="rejected")
+        await ctx.reply(f"⏳ {e}")
+
+async def chat_reply(ctx, message, started):
+    """Reply to the message, returns False if it failed with an error"""
+    try:
+        # First send the 'thinking' message as a reply
+        thinking_msg = await ctx.reply(f"🤖 Đang suy nghĩ...")
+        if STREAM_RESPONSES:
+            await stream_chat_reply(ctx, thinking_msg, message, started)
+            return True
+        # Get AI response (this may take time)
+        ai_response = await get_ai_response(message, ctx.author.id)
+        # Prepare the code block response and mention the user
+        code_response = f"\n```{ai_response}```"
+        # Edit the reply message to show the final answer
+        await thinking_msg.edit(content=code_response)
+
+        # Check if ctx.author is in a voice channel
+        if not ctx.guild or not ctx.author.voice:
+            # If user is not in voice, just return after sending text response
+            return True
+
+        # Queue the reply in the guild's voice session, it plays after anything already queued
+        speech = Utterance(ctx.author.voice.channel, started=started)
+        speech.add(ai_response)
+        speech.close()
+        voice_sessions.speak(ctx.guild, speech)
+        return True
+    except discord.errors.PrivilegedIntentsRequired:
+        await ctx.send("Error: Please enable privileged intents in the Discord Developer Portal!")
+        print("Error: Please enable privileged intents in the Discord Developer Portal!")
+    except openai.APIError as e: # Catch API errors specifically
+        error_message = str(e)
+        print(f"API Error during chat command: {error_message}")
+        await ctx.send(f"🤖 Error contacting AI: {error_message}")
+    except Exception as e:
+        ERRORS.inc(stage="chat")
+        await ctx.send(f"An error occurred: {str(e)}")
+        print(f"Error in chat command: {str(e)}")
+    return False
+
+@bot.command(name='clear')
+async def clear_history(ctx):
+    """Clear the conversation history for the user"""
+    if await run_store(conversation_store.exists, ctx.author.id):
+        await run_store(conversation_store.create, ctx.author.id, "You are a friendly and helpful AI assistant named Waifu. You speak in a cute, anime-style tone and always refer to the user as 'onii-chan'! Keep your responses concise, playful, and engaging. If the user speaks Vietnamese, reply in Vietnamese while maintaining the same anime-style cuteness. You are always happy to help onii-chan!")
+        await ctx.send("Conversation history cleared! Let's start fresh! 😊")
+    else:
+        await ctx.send("No conversation history to clear!")
+
+@bot.command(name='disconnect', aliases=['dc', 'leave'])
+async def disconnect_voice(ctx):
+    """Disconnect the bot from the voice channel"""
+    if ctx.voice_client:
+        await voice_sessions.close(ctx.guild)
+        await ctx.send("Disconnected from voice channel! 👋")
+    else:
+        await ctx.send("I'm not connected to any voice channel!")
+
+@bot.command(name='tts')
+async def set_speech_engine(ctx, engine: str = None):
+    """Show or change the speech engine used in this server"""
+    if ctx.guild is None:
+        await ctx.send("The speech engine can only be changed in a server!")
+        return
+    
+    names = ", ".join(tts.synthesizers)
+    if engine is None:
+        current = tts.synthesizer_for(ctx.guild.id)
+        await ctx.send(f"This server uses the `{current.name}` speech engine (available: {names}).")
+        return
+    
+    if not ctx.author.guild_permissions.manage_guild:
+        await ctx.send("You need the Manage Server permission to change the speech engine!")
+        return
+    
+    synthesizer = tts.synthesizers.get(engine.lower())
+    if synthesizer is None:
+        await ctx.send(f"Unknown speech engine `{engine}`, pick one of: {names}.")
+        return
+    if not synthesizer.available():
+        await ctx.send(f"The `{synthesizer.name}` speech engine isn't available right now.")
+        return
+    
+    tts.guild_synthesizers[ctx.guild.id] = synthesizer.name
+    await ctx.send(f"This server now uses the `{synthesizer.name}` speech engine.")
+
+@bot.command(name='testvoice')
+async def test_voice(ctx):
+    """Test the voice functionality"""
+    if not ctx.author.voice:
+        await ctx.send("You need to be in a voice channel to test voice!")
+        return
+        
+    try:
+        test_text = "Hello! This is a test of the voice system. Can you hear me?"
+        audio = await tts.generate_speech(test_text, ctx.guild.id)
+        if not audio:
+            await ctx.send("Failed to generate test audio. Please check the console for errors.")
+            return
+        
+        # Play the test audio ahead of any queued replies
+        speech = Utterance(ctx.author.voice.channel, priority=PRIORITY_HIGH)
+        speech.add_audio(audio)
+        speech.close()
+        voice_sessions.speak(ctx.guild, speech)
+        
+        await ctx.send("Playing test audio... 🎵")
+    except Exception as e:
+        print(f"Voice test error: {e}")
+        await ctx.send(f"Failed to test voice: {e}")
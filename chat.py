@@ -0,0 +1,161 @@
+"""Building the model's context from a user's history and getting the AI's reply"""
+import asyncio
+
+import openai
+
+from config import LLM_CONCURRENCY, SENTENCE_END, SUMMARIZE_HISTORY, TTS_MIN_CHARS
+from llm import model_router
+from metrics import ERRORS
+from resilience import ServiceUnavailable
+from store import context_budget, conversation_store, run_store
+from tasks import spawn
+
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+async def start_turn(message, user_id):
+    """Record the user's message and return the history to send to the model"""
+    conversation = await run_store(record_message, message, user_id)
+    # Each model gets as much history as fits its own token budget
+    return lambda model: build_context(conversation, context_budget(model))
+
+def record_message(message, user_id):
+    """Add the user's message to their history and return the conversation, on the store thread"""
+    # Initialize conversation history for new users
+    if not conversation_store.exists(user_id):
+        conversation_store.create(user_id, "Bạn là một trợ lý AI thân thiện và hữu ích tên là Waifu. Bạn nên trả lời theo cách tự nhiên, giao tiếp. Giữ cho câu trả lời của bạn dễ thương và hấp dẫn. Nếu người dùng nói tiếng Việt, hãy trả lời bằng tiếng Việt. Hãy gọi người dùng là 'Onii-chan'")
+    
+    # Add user message to history
+    conversation_store.append(user_id, "user", message)
+    return conversation_store.get(user_id)
+
+def split_history(conversation, budget):
+    """Split the conversation's messages into (older, recent) where recent is the newest
+    messages that fit in the token budget alongside the system prompt and summary"""
+    used = conversation.system.tokens + (conversation.summary.tokens if conversation.summary else 0)
+    messages = list(conversation.messages)
+    start = len(messages)
+    # Always include the newest message, even if it is over budget on its own
+    while start > 0 and (start == len(messages) or used + messages[start - 1].tokens <= budget):
+        start -= 1
+        used += messages[start].tokens
+    return messages[:start], messages[start:]
+
+def build_context(conversation, budget):
+    """Build the messages to send to the model, keeping the history within budget tokens"""
+    context = [conversation.system.as_dict()]
+    if conversation.summary:
+        context.append({"role": "system", "content": f"Summary of the earlier conversation: {conversation.summary.content}"})
+    _, recent = split_history(conversation, budget)
+    return context + [message.as_dict() for message in recent]
+
+async def remember_reply(user_id, ai_response):
+    """Add the AI response to the user's history, the store keeps only the latest messages"""
+    await run_store(conversation_store.append, user_id, "assistant", ai_response)
+    if SUMMARIZE_HISTORY:
+        maybe_summarize(user_id, await run_store(conversation_store.get, user_id))
+
+# Users whose history is being summarized right now
+summarizing = set()
+
+def maybe_summarize(user_id, conversation):
+    """Summarize messages that no longer fit the context budget, in the background"""
+    if conversation is None or user_id in summarizing:
+        return
+    older, _ = split_history(conversation, context_budget(model_router.endpoints[0].model))
+    if len(older) < 2:
+        return
+    summarizing.add(user_id)
+    spawn(summarize_history(user_id, conversation.summary, older))
+
+async def summarize_history(user_id, previous_summary, older):
+    transcript = "\n".join(f"{message.role}: {message.content}" for message in older)
+    if previous_summary:
+        transcript = f"Earlier summary: {previous_summary.content}\n{transcript}"
+    try:
+        async with llm_semaphore:
+            response = await model_router.complete(
+                lambda model: [
+                    {"role": "system", "content": "Summarize this conversation in a few sentences. Keep names, facts and anything the user asked to remember. Reply in the language of the conversation."},
+                    {"role": "user", "content": transcript}
+                ],
+                temperature=0.3
+            )
+        summary = response.choices[0].message.content
+        if summary:
+            dropped = await run_store(conversation_store.summarize, user_id, summary.strip(), older)
+            print(f"Summarized {dropped} old messages for user {user_id}")
+    except Exception as e:
+        print(f"Error summarizing conversation history: {e}")
+    finally:
+        summarizing.discard(user_id)
+
+# Errors from calling OpenRouter that get a friendly reply instead of a crash
+LLM_ERRORS = (openai.APIError, ServiceUnavailable, asyncio.TimeoutError)
+
+def api_error_reply(e):
+    """Turn an OpenAI API error into a message for the user"""
+    error_message = str(e) or type(e).__name__
+    print(f"OpenAI API Error: {error_message}")
+    ERRORS.inc(stage="llm")
+    
+    if getattr(e, 'status_code', None) == 402 or "insufficient_quota" in error_message:
+        return "I'm sorry, but I've run out of credits. Please check your OpenAI account billing details."
+    elif isinstance(e, openai.RateLimitError):
+        return "I'm receiving too many requests right now. Please try again in a moment."
+    elif isinstance(e, (ServiceUnavailable, asyncio.TimeoutError, openai.APITimeoutError)):
+        return "My brain is responding too slowly right now. Please try again in a moment."
+    else:
+        return "I'm having trouble connecting to my brain right now. Please check your OpenAI API key and try again."
+
+async def get_ai_response(message, user_id):
+    messages_for = await start_turn(message, user_id)
+    
+    try:
+        # Get response from OpenAI, limiting how many requests are in flight at once
+        async with llm_semaphore:
+            response = await model_router.complete(messages_for, temperature=0.7)
+        
+        # Get the response text
+        ai_response = response.choices[0].message.content
+        
+        # Add AI response to history
+        await remember_reply(user_id, ai_response)
+        
+        return ai_response
+    except LLM_ERRORS as e:
+        return api_error_reply(e)
+    except Exception as e:
+        print(f"Unexpected error: {str(e)}")
+        return "An unexpected error occurred. Please try again later."
+
+async def stream_ai_response(message, user_id):
+    """Yield the AI response piece by piece as the model generates it"""
+    messages_for = await start_turn(message, user_id)
+    parts = []
+    
+    try:
+        async with llm_semaphore:
+            async for delta in model_router.stream(messages_for, temperature=0.7):
+                parts.append(delta)
+                yield delta
+        
+        # Only keep complete replies in the history
+        await remember_reply(user_id, "".join(parts))
+    except LLM_ERRORS as e:
+        yield api_error_reply(e)
+    except Exception as e:
+        print(f"Unexpected error: {str(e)}")
+        yield "An unexpected error occurred. Please try again later."
+
+def pop_sentences(buffer, min_chars=TTS_MIN_CHARS):
+    """Split finished sentences off the front of buffer, returns (sentences, rest).
+    
+    Short sentences are merged with the next one so we don't make tiny TTS calls."""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(buffer):
+        sentence = buffer[start:match.end()].strip()
+        if len(sentence) >= min_chars:
+            sentences.append(sentence)
+            start = match.end()
+    return sentences, buffer[start:]
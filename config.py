@@ -0,0 +1,122 @@
+"""Settings for the bot, read from the environment and .env"""
+import os
+import re
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+Model_AI = "deepseek/deepseek-chat-v3-0324:free"
+
+# Models to route chat requests between, comma separated and in order of preference. Each entry
+# is model[@base_url][*weight], base_url defaults to OpenRouter and can point at any OpenAI
+# compatible server. A higher weight makes a model preferred even when it is a bit slower.
+LLM_MODELS = os.getenv('LLM_MODELS', Model_AI)
+LLM_HEDGE = os.getenv('LLM_HEDGE', '0') == '1'  # also ask the next model when the first one is slow
+LLM_HEDGE_DELAY = float(os.getenv('LLM_HEDGE_DELAY', 4))  # seconds before hedging, until we know a model's p95
+LLM_EXPLORE = float(os.getenv('LLM_EXPLORE', 0.05))  # share of requests sent to a random model to keep its stats fresh
+
+# Concurrency limits for the blocking/slow parts of the chat pipeline
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', 8))  # in-flight OpenRouter requests
+TTS_CONCURRENCY = int(os.getenv('TTS_CONCURRENCY', 4))  # ElevenLabs calls running at once
+
+SPEECH_GAIN_DB = float(os.getenv('SPEECH_GAIN_DB', 3))  # volume boost applied while decoding speech
+
+# ElevenLabs voice used for every reply
+VOICE_ID = os.getenv('VOICE_ID', '21m00Tcm4TlvDq8ikWAM')
+VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.75,
+    "style": 0.0,
+    "use_speaker_boost": True
+}
+TTS_MODEL = "eleven_flash_v2_5"
+
+# Speech engines: 'elevenlabs' or 'local' (a program on this machine, like espeak-ng or piper).
+# Guilds can pick their own with w-tts. When the local engine is installed it also stands in
+# for ElevenLabs when that fails, runs out of quota or takes longer than TTS_FALLBACK_AFTER
+TTS_BACKEND = os.getenv('TTS_BACKEND', 'elevenlabs')
+TTS_FALLBACK = os.getenv('TTS_FALLBACK', '1') == '1'
+TTS_FALLBACK_AFTER = float(os.getenv('TTS_FALLBACK_AFTER', 6))  # seconds ElevenLabs gets once it has a slot
+TTS_QUOTA_BACKOFF = float(os.getenv('TTS_QUOTA_BACKOFF', 600))  # seconds to stop calling ElevenLabs once out of quota
+LOCAL_TTS_COMMAND = os.getenv('LOCAL_TTS_COMMAND', 'espeak-ng --stdin --stdout')  # text on stdin, audio on stdout
+LOCAL_TTS_WORKERS = int(os.getenv('LOCAL_TTS_WORKERS') or os.cpu_count() or 2)  # local engine processes at once
+
+# Cache for generated speech, so repeated phrases don't cost another ElevenLabs call
+TTS_CACHE_MEMORY_MB = float(os.getenv('TTS_CACHE_MEMORY_MB', 32))
+TTS_CACHE_DISK_MB = float(os.getenv('TTS_CACHE_DISK_MB', 256))  # 0 disables the disk tier
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.tts_cache'))
+SCRATCH_SWEEP_SECONDS = float(os.getenv('SCRATCH_SWEEP_SECONDS', 30))  # how often released files are deleted
+SCRATCH_ORPHAN_SECONDS = float(os.getenv('SCRATCH_ORPHAN_SECONDS', 600))  # age after which stray temp files are collected
+
+# HTTP settings shared by the OpenRouter and ElevenLabs clients
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 20))  # per provider, idle ones are kept alive
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))  # retries after the first attempt
+HTTP_MAX_RETRY_AFTER = float(os.getenv('HTTP_MAX_RETRY_AFTER', 20))  # give up if told to wait longer than this
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 60))  # deadline for one OpenRouter call
+TTS_TIMEOUT = float(os.getenv('TTS_TIMEOUT', 20))  # deadline for one ElevenLabs call
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))  # failures in a row before we stop calling a provider
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', 30))  # how long to stop calling it for
+
+# Streaming replies: edit the Discord message as tokens arrive and speak each finished sentence
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+EDIT_INTERVAL = float(os.getenv('EDIT_INTERVAL', 1.0))  # seconds between message edits (Discord rate limits edits)
+TTS_MIN_CHARS = int(os.getenv('TTS_MIN_CHARS', 40))  # don't send sentences shorter than this to TTS on their own
+SENTENCE_END = re.compile(r'[.!?…。！？]+["\'”’)\]]*\s+|\n+')
+TTS_CHUNK_CHARS = int(os.getenv('TTS_CHUNK_CHARS', 250))  # longer text is synthesized in chunks of whole sentences
+TTS_PREFETCH = int(os.getenv('TTS_PREFETCH', 3))  # chunks of a reply synthesized ahead of playback
+
+# Voice sessions: one connection and playback queue per guild
+VOICE_IDLE_TIMEOUT = float(os.getenv('VOICE_IDLE_TIMEOUT', 300))  # seconds of silence before leaving voice
+PRIORITY_HIGH = 0  # lower numbers play first, FIFO within the same priority
+PRIORITY_NORMAL = 1
+
+# Admission control for w-chat, so one user or guild can't hog the bot or burn through API limits
+CHAT_USER_QUEUE = int(os.getenv('CHAT_USER_QUEUE', 2))  # messages per user being answered or waiting
+CHAT_GUILD_CONCURRENCY = int(os.getenv('CHAT_GUILD_CONCURRENCY', 3))  # replies generated at once per guild
+CHAT_GLOBAL_CONCURRENCY = int(os.getenv('CHAT_GLOBAL_CONCURRENCY', 10))  # replies generated at once overall
+CHAT_USER_RATE = float(os.getenv('CHAT_USER_RATE', 6))  # messages per minute per user
+CHAT_USER_BURST = int(os.getenv('CHAT_USER_BURST', 3))
+CHAT_GUILD_RATE = float(os.getenv('CHAT_GUILD_RATE', 30))  # messages per minute per guild
+CHAT_GUILD_BURST = int(os.getenv('CHAT_GUILD_BURST', 10))
+ADMISSION_WAIT = float(os.getenv('ADMISSION_WAIT', 2))  # seconds to wait for a free slot before giving up
+
+# Sharding: SHARD_COUNT is the number of shards across all processes and SHARD_IDS the ones
+# this process runs, like "0-3" or "4,5". Without them one process runs Discord's recommended count
+def parse_shard_ids(spec):
+    shard_ids = []
+    for part in spec.split(','):
+        if part.strip():
+            first, _, last = part.partition('-')
+            shard_ids.extend(range(int(first), int(last or first) + 1))
+    return shard_ids or None
+
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS', ''))
+
+# Web server for Render's health check, metrics and admin, running on the bot's event loop
+PORT = int(os.environ.get("PORT", 10000))
+HEALTH_MAX_LAG = float(os.getenv('HEALTH_MAX_LAG', 1.0))  # event loop lag (seconds) above which /healthz fails
+WEB_REQUEST_TIMEOUT = float(os.getenv('WEB_REQUEST_TIMEOUT', 10))  # seconds a client gets to send its request
+WEB_MAX_CONNECTIONS = int(os.getenv('WEB_MAX_CONNECTIONS', 100))
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')  # admin endpoints are disabled unless this is set
+MAX_REQUEST_HEAD = 16 * 1024
+
+# Conversation history settings
+CONVERSATION_STORE = os.getenv('CONVERSATION_STORE', 'sqlite')  # 'memory', 'sqlite', or 'shared' for several processes
+CONVERSATION_DB = os.getenv('CONVERSATION_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversations.db'))
+HISTORY_MESSAGES = int(os.getenv('HISTORY_MESSAGES', 30))  # messages kept per user, besides the system prompt
+HISTORY_TTL_HOURS = float(os.getenv('HISTORY_TTL_HOURS', 24))  # idle users are dropped from memory after this
+HISTORY_MEMORY_MB = float(os.getenv('HISTORY_MEMORY_MB', 16))  # cap on history held in memory for all users
+HISTORY_FLUSH_SECONDS = float(os.getenv('HISTORY_FLUSH_SECONDS', 5))  # how often SQLite writes are batched
+
+# How much history is sent to the model, in tokens. MODEL_CONTEXT_TOKENS overrides it per model
+# as a comma separated list of model=tokens pairs
+CONTEXT_TOKENS = int(os.getenv('CONTEXT_TOKENS', 2000))
+MODEL_CONTEXT_TOKENS = {
+    model.strip(): int(tokens)
+    for model, _, tokens in (pair.rpartition('=') for pair in os.getenv('MODEL_CONTEXT_TOKENS', '').split(',') if '=' in pair)
+}
+SUMMARIZE_HISTORY = os.getenv('SUMMARIZE_HISTORY', '0') == '1'  # summarize messages that no longer fit the budget
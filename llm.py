@@ -0,0 +1,241 @@
+"""Chat completions from OpenRouter or other OpenAI compatible servers, routed by latency and health"""
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+import httpx
+from openai import AsyncOpenAI
+
+from config import HTTP_CONNECT_TIMEOUT, LLM_EXPLORE, LLM_HEDGE, LLM_HEDGE_DELAY, LLM_MODELS, LLM_TIMEOUT
+from metrics import LLM_ENDPOINT_ERRORS, LLM_FIRST_TOKEN, LLM_TOTAL
+from resilience import CircuitBreaker, ServiceUnavailable, make_http_client
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1"
+
+def make_llm_client(base_url):
+    """Initialize an OpenAI client, with the OpenRouter headers when it talks to OpenRouter"""
+    return AsyncOpenAI(
+        base_url=base_url,
+        api_key=os.getenv('OPENAI_API_KEY') or "not-needed",
+        default_headers={
+            "HTTP-Referer": "https://waifu-bot.onrender.com", # Update with your Render URL
+            "X-Title": "Waifu.exe", # Your app name
+        } if base_url == OPENROUTER_URL else None,
+        http_client=make_http_client(LLM_TIMEOUT),
+        timeout=httpx.Timeout(LLM_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        max_retries=0  # retries are handled by each endpoint's CircuitBreaker
+    )
+
+class ModelEndpoint:
+    """One model on one server, with its rolling latency and error stats.
+    
+    Latencies are kept per kind of request: "stream" is the time until a streamed reply
+    started, "complete" the time for a whole completion."""
+    
+    WINDOW = 50  # recent requests the stats are based on
+    
+    def __init__(self, model, client, base_url, weight, order):
+        self.model = model
+        self.client = client
+        self.name = model if base_url == OPENROUTER_URL else f"{model}@{base_url}"
+        self.weight = weight
+        self.order = order
+        self.breaker = CircuitBreaker(self.name)
+        self.latencies = {kind: deque(maxlen=self.WINDOW) for kind in ("stream", "complete")}
+        self.outcomes = deque(maxlen=self.WINDOW)  # True for success
+    
+    def record_success(self, latency, kind="stream"):
+        self.latencies[kind].append(latency)
+        self.outcomes.append(True)
+    
+    def record_error(self):
+        self.outcomes.append(False)
+        LLM_ENDPOINT_ERRORS.inc(model=self.name)
+    
+    def record_cancelled(self, elapsed, kind="stream"):
+        # Lost a hedge race: the real latency is at least this long
+        self.latencies[kind].append(elapsed)
+    
+    def percentile(self, fraction, kind="stream"):
+        if not self.latencies[kind]:
+            return None
+        ordered = sorted(self.latencies[kind])
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+    
+    def healthy(self):
+        return self.breaker.opened_at is None and self.error_rate() < 0.5
+    
+    def expected_latency(self, kind="stream"):
+        # Until we've seen a few replies assume it is as fast as the hedge delay allows
+        if len(self.latencies[kind]) < 3:
+            return LLM_HEDGE_DELAY / 2
+        return self.percentile(0.5, kind)
+    
+    def hedge_delay(self, kind="stream"):
+        if len(self.latencies[kind]) < 5:
+            return LLM_HEDGE_DELAY
+        return self.percentile(0.95, kind)
+    
+    def stats(self):
+        return {
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "complete_p50": self.percentile(0.5, "complete"),
+            "error_rate": self.error_rate(),
+            "requests": len(self.outcomes),
+            "healthy": self.healthy(),
+        }
+
+class ModelRouter:
+    """Sends each chat request to the fastest healthy model and fails over to the next.
+    
+    With hedging on, a request that gets no reply within the model's p95 latency is also
+    sent to the next model, and whichever answers first is used."""
+    
+    def __init__(self, spec):
+        clients = {}
+        self.endpoints = []
+        for order, entry in enumerate(item.strip() for item in spec.split(',') if item.strip()):
+            entry, _, weight = entry.partition('*')
+            model, _, base_url = entry.partition('@')
+            base_url = base_url or OPENROUTER_URL
+            if base_url not in clients:
+                clients[base_url] = make_llm_client(base_url)
+            self.endpoints.append(ModelEndpoint(model.strip(), clients[base_url], base_url, float(weight or 1), order))
+        print(f"Routing chat between: {', '.join(endpoint.name for endpoint in self.endpoints)}")
+    
+    def ranked(self, kind="stream"):
+        """Endpoints in the order to try them: healthy and fast first"""
+        ranked = sorted(
+            self.endpoints,
+            key=lambda e: (not e.healthy(), e.expected_latency(kind) / e.weight, e.order)
+        )
+        # Now and then try another model first so its stats don't go stale
+        if len(ranked) > 1 and random.random() < LLM_EXPLORE:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+    
+    async def _route(self, attempt, discard, kind):
+        """Run attempt(endpoint) on the best endpoint, hedging and failing over as needed"""
+        candidates = self.ranked(kind)
+        tasks = {}
+        last_error = None
+        try:
+            while candidates or tasks:
+                if candidates and not tasks:
+                    primary = candidates.pop(0)
+                    tasks[asyncio.ensure_future(attempt(primary))] = primary
+                    if LLM_HEDGE and candidates:
+                        done, _ = await asyncio.wait(tasks, timeout=primary.hedge_delay(kind))
+                        if not done:
+                            backup = candidates.pop(0)
+                            print(f"{primary.name} is slow, also asking {backup.name}")
+                            tasks[asyncio.ensure_future(attempt(backup))] = backup
+                
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    endpoint = tasks.pop(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        print(f"{endpoint.name} failed ({type(last_error).__name__}), trying the next model")
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        await discard(task.result())
+                if winner is not None:
+                    return winner
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise last_error or ServiceUnavailable("No language model is available")
+    
+    async def complete(self, messages_for, **kwargs):
+        """Get a whole completion. messages_for(model) builds the messages for a model"""
+        async def attempt(endpoint):
+            started = time.monotonic()
+            try:
+                response = await endpoint.breaker.call(lambda: endpoint.client.chat.completions.create(
+                    model=endpoint.model,
+                    messages=messages_for(endpoint.model),
+                    **kwargs
+                ), LLM_TIMEOUT)
+            except asyncio.CancelledError:
+                endpoint.record_cancelled(time.monotonic() - started, "complete")
+                raise
+            except Exception:
+                endpoint.record_error()
+                raise
+            endpoint.record_success(time.monotonic() - started, "complete")
+            LLM_TOTAL.observe(time.monotonic() - started, model=endpoint.name)
+            return response
+        
+        async def discard(response):
+            pass
+        
+        return await self._route(attempt, discard, "complete")
+    
+    async def stream(self, messages_for, **kwargs):
+        """Yield the completion text piece by piece from whichever model starts answering first"""
+        async def attempt(endpoint):
+            started = time.monotonic()
+            try:
+                # Retries only cover opening the stream, not failures halfway through a reply
+                stream = await endpoint.breaker.call(lambda: endpoint.client.chat.completions.create(
+                    model=endpoint.model,
+                    messages=messages_for(endpoint.model),
+                    stream=True,
+                    **kwargs
+                ), LLM_TIMEOUT)
+            except asyncio.CancelledError:
+                endpoint.record_cancelled(time.monotonic() - started)
+                raise
+            except Exception:
+                endpoint.record_error()
+                raise
+            try:
+                # A model only counts as answering once the first text arrives
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        break
+                else:
+                    delta = ""
+            except asyncio.CancelledError:
+                endpoint.record_cancelled(time.monotonic() - started)
+                await stream.close()
+                raise
+            except Exception:
+                endpoint.record_error()
+                await stream.close()
+                raise
+            endpoint.record_success(time.monotonic() - started)
+            LLM_FIRST_TOKEN.observe(time.monotonic() - started, model=endpoint.name)
+            return endpoint, started, stream, delta
+        
+        async def discard(result):
+            await result[2].close()
+        
+        endpoint, started, stream, delta = await self._route(attempt, discard, "stream")
+        try:
+            if delta:
+                yield delta
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+            LLM_TOTAL.observe(time.monotonic() - started, model=endpoint.name)
+        finally:
+            await stream.close()
+    
+    def stats(self):
+        return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
+
+model_router = ModelRouter(LLM_MODELS)
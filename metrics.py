@@ -0,0 +1,144 @@
+"""Latency histograms, counters and gauges in the Prometheus text format"""
+import asyncio
+import contextlib
+import threading
+import time
+
+# Metrics, exposed in the Prometheus text format on /metrics
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+all_metrics = []
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+class Metric:
+    kind = "untyped"
+    
+    def __init__(self, name, help, function=None):
+        """function, if given, is called when collecting and returns the value,
+        or a dict of {labels tuple: value} for labelled metrics"""
+        self.name = name
+        self.help = help
+        self.function = function
+        self.values = {}  # sorted labels tuple -> value
+        # Updated from voice threads and the event loop, read by the web server
+        self.lock = threading.Lock()
+        all_metrics.append(self)
+    
+    def samples(self):
+        """(suffix, labels, value) for every series of this metric"""
+        if self.function:
+            value = self.function()
+            items = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self.lock:
+                items = list(self.values.items())
+        return [("", labels, value) for labels, value in items]
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+    
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]  # bucket counts, sum, count
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+    
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+    
+    def samples(self):
+        with self.lock:
+            items = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self.values.items()]
+        samples = []
+        for labels, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                samples.append(("_bucket", labels + (("le", bound),), bucket_count))
+            samples.append(("_bucket", labels + (("le", "+Inf"),), count))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in all_metrics) + "\n"
+
+LLM_FIRST_TOKEN = Histogram("waifu_llm_first_token_seconds", "Time until the model started answering")
+LLM_TOTAL = Histogram("waifu_llm_total_seconds", "Time until the model finished answering")
+LLM_ENDPOINT_ERRORS = Counter("waifu_llm_endpoint_errors_total", "Failed calls per model, before failover")
+TTS_SYNTHESIS = Histogram("waifu_tts_synthesis_seconds", "Time to synthesize speech per engine")
+TTS_FALLBACKS = Counter("waifu_tts_fallbacks_total", "Speech synthesized locally because ElevenLabs failed or was slow")
+TRANSCODE_START = Histogram("waifu_transcode_start_seconds", "Time for ffmpeg to decode the first audio frame of a reply")
+SPEECH_UNDERRUN = Counter("waifu_speech_underrun_seconds_total", "Silence played mid-reply while waiting for the next chunk")
+VOICE_CONNECT = Histogram("waifu_voice_connect_seconds", "Time to connect to or move between voice channels")
+PLAYBACK_START = Histogram("waifu_playback_start_seconds", "Time from a chat command to the first spoken audio")
+CHAT_REPLY = Histogram("waifu_chat_reply_seconds", "Time from a chat command to the full text reply")
+CHAT_REQUESTS = Counter("waifu_chat_requests_total", "Chat commands by outcome")
+ERRORS = Counter("waifu_errors_total", "Errors by stage")
+EVENT_LOOP_LAG = Gauge("waifu_event_loop_lag_seconds", "How late the event loop ran a scheduled callback")
+
+async def monitor_event_loop(interval=0.5):
+    """Measure how far behind the event loop is running, blocking calls show up here"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(0.0, time.monotonic() - started - interval))
+
+class StartupTimer:
+    """Time from launch until each phase of startup, logged and exported on /metrics"""
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}  # phase -> seconds after launch
+        Gauge("waifu_startup_seconds", "Seconds from launch until each startup phase finished",
+              function=lambda: {(("phase", phase),): seconds for phase, seconds in self.phases.items()})
+    
+    def mark(self, phase):
+        """Record the first time phase is reached, later calls (like reconnects) are ignored"""
+        if phase in self.phases:
+            return
+        elapsed = time.monotonic() - self.started
+        self.phases[phase] = round(elapsed, 3)
+        print(f"Startup: {phase} after {elapsed:.2f}s")
+
+# Imported first by waifu.py, so the timer starts before the slow imports
+startup = StartupTimer()
@@ -0,0 +1,114 @@
+"""HTTP clients, retries and circuit breakers shared by the OpenRouter and ElevenLabs calls"""
+import asyncio
+import email.utils
+import random
+import time
+from datetime import datetime, timezone
+
+import httpx
+import openai
+
+from config import (
+    BREAKER_FAILURES, BREAKER_RESET_SECONDS, HTTP_CONNECT_TIMEOUT, HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_RETRY_AFTER, HTTP_RETRIES
+)
+
+def make_http_client(timeout, **kwargs):
+    """Create a connection pooled HTTP client that keeps connections alive between calls"""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=60
+        ),
+        **kwargs
+    )
+
+class ServiceUnavailable(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open"""
+
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+def is_retryable(error):
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError, openai.APIConnectionError)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code in RETRYABLE_STATUS
+
+def retry_after(error):
+    """Seconds the server asked us to wait (Retry-After header), or None"""
+    response = getattr(error, 'response', None)
+    value = response.headers.get('retry-after') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class CircuitBreaker:
+    """Retries failed calls to a provider and stops calling it when it keeps failing.
+    
+    After `threshold` failures in a row the breaker opens and calls fail right away with
+    ServiceUnavailable. Once reset_timeout has passed a single call is let through, and
+    the breaker closes again if it succeeds."""
+    
+    def __init__(self, name, threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+    
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            # Let one trial call through, everyone else waits for another reset_timeout
+            self.opened_at = time.monotonic()
+            return True
+        return False
+    
+    def is_open(self):
+        """Whether calls would be refused right now, without using up the trial call"""
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                print(f"{self.name} keeps failing, pausing calls for {self.reset_timeout:.0f}s")
+            self.opened_at = time.monotonic()
+    
+    async def call(self, make_call, deadline):
+        """Run make_call() with a deadline, retrying with jittered exponential backoff"""
+        for attempt in range(HTTP_RETRIES + 1):
+            if not self.allow():
+                raise ServiceUnavailable(f"{self.name} is unavailable right now")
+            try:
+                result = await asyncio.wait_for(make_call(), deadline)
+            except Exception as e:
+                if not is_retryable(e):
+                    # The provider answered, it just didn't like the request
+                    self.record_success()
+                    raise
+                self.record_failure()
+                delay = retry_after(e)
+                if delay is None:
+                    delay = min(8.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                if attempt == HTTP_RETRIES or delay > HTTP_MAX_RETRY_AFTER or self.opened_at is not None:
+                    raise
+                print(f"{self.name} call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                self.record_success()
+                return result
@@ -0,0 +1,409 @@
+"""Conversation history, kept in memory and optionally persisted to SQLite"""
+import asyncio
+import atexit
+import random
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    CONTEXT_TOKENS, CONVERSATION_DB, CONVERSATION_STORE, HISTORY_FLUSH_SECONDS, HISTORY_MEMORY_MB,
+    HISTORY_MESSAGES, HISTORY_TTL_HOURS, MODEL_CONTEXT_TOKENS
+)
+from metrics import Gauge
+
+# tiktoken is optional, without it token counts are estimated from the text length.
+# Loading it is slow, so it happens on first use or when warmed up after login
+token_encoding = None
+token_encoding_loaded = False
+
+def load_token_encoding():
+    global token_encoding, token_encoding_loaded
+    if not token_encoding_loaded:
+        try:
+            import tiktoken
+            token_encoding = tiktoken.get_encoding("cl100k_base")
+        except ImportError:
+            pass
+        except Exception as e:
+            print(f"Couldn't load the tiktoken encoding, estimating token counts instead: {e}")
+        token_encoding_loaded = True
+    return token_encoding
+
+def count_tokens(text):
+    """Count (or estimate) the tokens in text, including per-message overhead"""
+    encoding = token_encoding if token_encoding_loaded else load_token_encoding()
+    if encoding:
+        return len(encoding.encode(text)) + 4
+    # English averages about 4 bytes per token, but accented and CJK text take fewer bytes per
+    # token, so 3 bytes per token stays on the safe side for Vietnamese
+    return len(text.encode('utf-8')) // 3 + 4
+
+def context_budget(model):
+    return MODEL_CONTEXT_TOKENS.get(model, CONTEXT_TOKENS)
+
+class Message:
+    __slots__ = ('role', 'content', 'size', 'tokens')
+    
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
+        self.size = sys.getsizeof(content) + 64  # string plus this object, roughly
+        self.tokens = count_tokens(content)
+    
+    def as_dict(self):
+        return {"role": self.role, "content": self.content}
+
+class Conversation:
+    """One user's system prompt plus a ring buffer of their latest messages"""
+    __slots__ = ('system', 'summary', 'messages', 'last_active', 'size')
+    
+    def __init__(self, system, max_messages):
+        self.system = Message("system", system)
+        self.summary = None  # rolling summary of messages that were dropped
+        self.messages = deque(maxlen=max_messages)
+        self.last_active = time.time()
+        self.size = self.system.size
+    
+    def append(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self.size -= self.messages[0].size
+        self.messages.append(message)
+        self.size += message.size
+        self.last_active = time.time()
+    
+    def set_summary(self, summary, summarized):
+        """Replace the summarized messages (the oldest ones) with a summary, returns how many were dropped.
+        
+        Nothing changes unless they are still at the front, the conversation may have been
+        cleared or moved on while the summary was being written."""
+        summarized = {id(message) for message in summarized}
+        if not self.messages or id(self.messages[0]) not in summarized:
+            return 0
+        if self.summary:
+            self.size -= self.summary.size
+        self.summary = Message("system", summary)
+        self.size += self.summary.size
+        dropped = 0
+        while self.messages and id(self.messages[0]) in summarized:
+            self.size -= self.messages.popleft().size
+            dropped += 1
+        return dropped
+
+class ConversationStore:
+    """Where conversation history lives. Backends implement these methods"""
+    
+    def exists(self, user_id):
+        raise NotImplementedError
+    
+    def create(self, user_id, system):
+        """Start (or restart) a conversation with the given system prompt"""
+        raise NotImplementedError
+    
+    def append(self, user_id, role, content):
+        raise NotImplementedError
+    
+    def get(self, user_id):
+        """Return the user's Conversation, or None"""
+        raise NotImplementedError
+    
+    def summarize(self, user_id, summary, summarized):
+        """Replace the given (oldest) messages with a summary of them"""
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+
+class MemoryConversationStore(ConversationStore):
+    """Keeps history in memory with a bounded number of messages per user.
+    
+    Users idle for longer than ttl are forgotten, and the least recently active users
+    are forgotten first when the whole store grows past max_bytes."""
+    
+    def __init__(self, max_messages, ttl, max_bytes):
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.conversations = OrderedDict()  # user_id -> Conversation, least recently active first
+        self.size = 0
+    
+    def exists(self, user_id):
+        self._evict()
+        return user_id in self.conversations
+    
+    def create(self, user_id, system):
+        self._drop(user_id)
+        conversation = Conversation(system, self.max_messages)
+        self.conversations[user_id] = conversation
+        self.size += conversation.size
+        self._evict()
+        return conversation
+    
+    def append(self, user_id, role, content):
+        conversation = self.conversations.get(user_id)
+        if conversation is None:
+            return
+        self.size -= conversation.size
+        conversation.append(Message(role, content))
+        self.size += conversation.size
+        self.conversations.move_to_end(user_id)
+        self._evict()
+    
+    def get(self, user_id):
+        return self.conversations.get(user_id)
+    
+    def summarize(self, user_id, summary, summarized):
+        conversation = self.conversations.get(user_id)
+        if conversation is None:
+            return 0
+        self.size -= conversation.size
+        dropped = conversation.set_summary(summary, summarized)
+        self.size += conversation.size
+        return dropped
+    
+    def _drop(self, user_id):
+        conversation = self.conversations.pop(user_id, None)
+        if conversation is not None:
+            self.size -= conversation.size
+    
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        # Never evict the conversation that is currently being used
+        while len(self.conversations) > 1:
+            user_id, oldest = next(iter(self.conversations.items()))
+            if oldest.last_active >= cutoff and self.size <= self.max_bytes:
+                break
+            self._drop(user_id)
+
+class SQLiteConversationStore(MemoryConversationStore):
+    """Persists history to SQLite so it survives restarts.
+    
+    The in-memory store acts as a cache in front of the database. Writes are queued and
+    flushed in batches by a background thread, so replying never waits on the disk."""
+    
+    def __init__(self, path, max_messages, ttl, max_bytes, flush_interval):
+        super().__init__(max_messages, ttl, max_bytes)
+        self.flush_interval = flush_interval
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db_lock = threading.RLock()  # also held from taking a batch of writes until it is committed
+        self.pending = []  # writes waiting for the next flush
+        self.pending_lock = threading.Lock()
+        self.versions = {}  # user_id -> version of the conversation we have in memory
+        self.wakeup = threading.Event()
+        self.closed = False
+        with self.db_lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "user_id INTEGER PRIMARY KEY, system TEXT NOT NULL, last_active REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+                "role TEXT NOT NULL, content TEXT NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS messages_by_user ON messages (user_id, id)")
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(conversations)")]
+            if "summary" not in columns:
+                self.db.execute("ALTER TABLE conversations ADD COLUMN summary TEXT")
+            if "version" not in columns:
+                self.db.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        threading.Thread(target=self._flush_loop, daemon=True, name='history-flush').start()
+    
+    def exists(self, user_id):
+        return super().exists(user_id) or self._load(user_id)
+    
+    def create(self, user_id, system):
+        conversation = super().create(user_id, system)
+        self._queue(("create", user_id, system, conversation.last_active))
+        return conversation
+    
+    def append(self, user_id, role, content):
+        if user_id not in self.conversations and not self._load(user_id):
+            return
+        super().append(user_id, role, content)
+        self._queue(("append", user_id, role, content, time.time()))
+    
+    def get(self, user_id):
+        if user_id not in self.conversations:
+            self._load(user_id)
+        return super().get(user_id)
+    
+    def summarize(self, user_id, summary, summarized):
+        dropped = super().summarize(user_id, summary, summarized)
+        if dropped:
+            self._queue(("summary", user_id, summary, dropped))
+        return dropped
+    
+    def _queue(self, write):
+        with self.pending_lock:
+            self.pending.append(write)
+    
+    def _load(self, user_id):
+        """Bring a conversation from the database back into memory"""
+        with self.db_lock:
+            # No flush is halfway while we hold the lock, so pending has every unsaved write
+            with self.pending_lock:
+                has_pending = any(write[1] == user_id for write in self.pending)
+            if has_pending:
+                self.flush()
+            row = self.db.execute(
+                "SELECT system, summary, version FROM conversations WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            rows = self.db.execute(
+                "SELECT role, content FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, self.max_messages)
+            ).fetchall()
+        conversation = MemoryConversationStore.create(self, user_id, row[0])
+        self.size -= conversation.size
+        for role, content in reversed(rows):
+            conversation.append(Message(role, content))
+        if row[1]:
+            conversation.summary = Message("system", row[1])
+            conversation.size += conversation.summary.size
+        self.size += conversation.size
+        self.versions[user_id] = row[2]
+        return True
+    
+    def _drop(self, user_id):
+        super()._drop(user_id)
+        self.versions.pop(user_id, None)
+    
+    def flush(self):
+        """Write all queued changes to the database in one transaction"""
+        # Batches are committed in the order they were taken, an older "create" committed
+        # after newer appends would delete them
+        with self.db_lock:
+            with self.pending_lock:
+                writes, self.pending = self.pending, []
+            if not writes:
+                return
+            self._write(writes)
+    
+    def _write(self, writes):
+        # Called with db_lock held
+        touched = set()
+        try:
+            with self.db:
+                for write in writes:
+                    if write[0] == "create":
+                        _, user_id, system, last_active = write
+                        self.db.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+                        self.db.execute(
+                            "INSERT OR REPLACE INTO conversations (user_id, system, last_active) VALUES (?, ?, ?)",
+                            (user_id, system, last_active)
+                        )
+                    elif write[0] == "summary":
+                        _, user_id, summary, dropped = write
+                        self.db.execute(
+                            "UPDATE conversations SET summary = ? WHERE user_id = ?", (summary, user_id)
+                        )
+                        # Messages that rotated out in memory are still here until the trim below,
+                        # trim now so the oldest rows are the ones that were summarized
+                        self._trim(user_id)
+                        self.db.execute(
+                            "DELETE FROM messages WHERE id IN "
+                            "(SELECT id FROM messages WHERE user_id = ? ORDER BY id LIMIT ?)",
+                            (user_id, dropped)
+                        )
+                    else:
+                        _, user_id, role, content, last_active = write
+                        self.db.execute(
+                            "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+                            (user_id, role, content)
+                        )
+                        self.db.execute(
+                            "UPDATE conversations SET last_active = ? WHERE user_id = ?",
+                            (last_active, user_id)
+                        )
+                    touched.add(user_id)
+                for user_id in touched:
+                    self._trim(user_id)
+                    # Lets other processes sharing the database notice the change
+                    version = random.getrandbits(62)
+                    self.db.execute("UPDATE conversations SET version = ? WHERE user_id = ?", (version, user_id))
+                    if user_id in self.conversations:
+                        self.versions[user_id] = version
+        except sqlite3.Error as e:
+            print(f"Error saving conversation history: {e}")
+    
+    def _trim(self, user_id):
+        # Only the latest messages are ever sent to the model, drop the rest
+        self.db.execute(
+            "DELETE FROM messages WHERE user_id = ? AND id NOT IN "
+            "(SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+            (user_id, user_id, self.max_messages)
+        )
+    
+    def _flush_loop(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.flush()
+    
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+
+class SharedSQLiteConversationStore(SQLiteConversationStore):
+    """SQLite history that several bot processes (like shards) can use at the same time.
+    
+    Writes go to the database right away instead of being batched, and a conversation
+    cached in memory is reloaded when another process has changed it since."""
+    
+    def __init__(self, path, max_messages, ttl, max_bytes):
+        super().__init__(path, max_messages, ttl, max_bytes, flush_interval=60)
+    
+    def exists(self, user_id):
+        self._refresh(user_id)
+        return super().exists(user_id)
+    
+    def append(self, user_id, role, content):
+        self._refresh(user_id)
+        super().append(user_id, role, content)
+    
+    def get(self, user_id):
+        self._refresh(user_id)
+        return super().get(user_id)
+    
+    def _queue(self, write):
+        super()._queue(write)
+        self.flush()
+    
+    def _refresh(self, user_id):
+        """Forget our copy of a conversation that another process has written to"""
+        if user_id not in self.conversations:
+            return
+        with self.db_lock:
+            row = self.db.execute("SELECT version FROM conversations WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or row[0] != self.versions.get(user_id):
+            self._drop(user_id)
+
+def create_conversation_store():
+    ttl = HISTORY_TTL_HOURS * 3600
+    max_bytes = int(HISTORY_MEMORY_MB * 1024 * 1024)
+    if CONVERSATION_STORE == 'shared':
+        return SharedSQLiteConversationStore(CONVERSATION_DB, HISTORY_MESSAGES, ttl, max_bytes)
+    if CONVERSATION_STORE == 'sqlite':
+        return SQLiteConversationStore(CONVERSATION_DB, HISTORY_MESSAGES, ttl, max_bytes, HISTORY_FLUSH_SECONDS)
+    return MemoryConversationStore(HISTORY_MESSAGES, ttl, max_bytes)
+
+# Store conversation history
+conversation_store = create_conversation_store()
+atexit.register(conversation_store.close)
+
+# Store calls can load from or write to SQLite, so the bot makes them here instead of on the
+# event loop. A single thread keeps them in order without locking the in-memory store
+store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+
+async def run_store(function, *args):
+    """Run a conversation store call on the store thread"""
+    return await asyncio.get_running_loop().run_in_executor(store_executor, function, *args)
+
+Gauge("waifu_history_memory_bytes", "Approximate memory used by conversation history", function=lambda: conversation_store.size)
+Gauge("waifu_history_users", "Users with conversation history in memory", function=lambda: len(conversation_store.conversations))
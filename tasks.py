@@ -0,0 +1,11 @@
+"""Fire-and-forget tasks that are kept alive until they finish"""
+import asyncio
+
+# Keep references to fire-and-forget tasks so they aren't garbage collected
+background_tasks = set()
+
+def spawn(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
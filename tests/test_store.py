@@ -0,0 +1,60 @@
+"""Tests for the SQLite conversation history. Run with: python -m unittest discover tests"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('CONVERSATION_STORE', 'memory')  # keep the module level store off the disk
+
+from store import SQLiteConversationStore  # noqa: E402
+
+class SQLiteConversationStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "history.db")
+        self.stores = []
+    
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+            store.db.close()
+        self.directory.cleanup()
+    
+    def open_store(self):
+        store = SQLiteConversationStore(self.path, max_messages=4, ttl=3600, max_bytes=1 << 20, flush_interval=3600)
+        self.stores.append(store)
+        return store
+    
+    def test_summary_after_rotated_appends_in_one_flush(self):
+        store = self.open_store()
+        store.create(1, "system")
+        for i in range(6):
+            store.append(1, "user", f"m{i}")
+        conversation = store.get(1)
+        self.assertEqual([message.content for message in conversation.messages], ["m2", "m3", "m4", "m5"])
+        store.summarize(1, "summary of m2 and m3", list(conversation.messages)[:2])
+        store.flush()
+        
+        reloaded = self.open_store().get(1)
+        self.assertEqual([message.content for message in reloaded.messages], ["m4", "m5"])
+        self.assertEqual(reloaded.summary.content, "summary of m2 and m3")
+
+    def test_summary_of_cleared_conversation_is_ignored(self):
+        store = self.open_store()
+        store.create(1, "system")
+        store.append(1, "user", "old question")
+        store.append(1, "assistant", "old answer")
+        older = list(store.get(1).messages)
+        store.create(1, "system")  # w-clear while the summary is being written
+        store.append(1, "user", "new question")
+        
+        self.assertEqual(store.summarize(1, "summary of the old messages", older), 0)
+        self.assertIsNone(store.get(1).summary)
+        store.flush()
+        reloaded = self.open_store().get(1)
+        self.assertIsNone(reloaded.summary)
+        self.assertEqual([message.content for message in reloaded.messages], ["new question"])
+
+if __name__ == '__main__':
+    unittest.main()
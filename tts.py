@@ -0,0 +1,622 @@
+"""Speech synthesis with ElevenLabs, cached in memory and on disk"""
+import asyncio
+import atexit
+import hashlib
+import io
+import itertools
+import json
+import os
+import shlex
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import discord
+
+from config import (
+    LOCAL_TTS_COMMAND, LOCAL_TTS_WORKERS, SCRATCH_ORPHAN_SECONDS, SCRATCH_SWEEP_SECONDS, SENTENCE_END,
+    SPEECH_GAIN_DB, TTS_BACKEND, TTS_CACHE_DIR, TTS_CACHE_DISK_MB, TTS_CACHE_MEMORY_MB, TTS_CHUNK_CHARS,
+    TTS_CONCURRENCY, TTS_FALLBACK, TTS_FALLBACK_AFTER, TTS_MIN_CHARS, TTS_MODEL, TTS_QUOTA_BACKOFF,
+    TTS_TIMEOUT, VOICE_ID, VOICE_SETTINGS
+)
+from metrics import ERRORS, TTS_FALLBACKS, TTS_SYNTHESIS, Counter, Gauge
+from resilience import CircuitBreaker, ServiceUnavailable, make_http_client
+
+# Disk reads and writes for the speech cache happen here so they never block the event loop
+disk_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='tts-cache')
+tts_semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+
+elevenlabs_breaker = CircuitBreaker("ElevenLabs")
+
+# Created on first voice use, so text-only startups never pay for them
+elevenlabs_http = None
+tts_cache = None
+tts_cache_lock = threading.Lock()
+
+def get_elevenlabs_http():
+    global elevenlabs_http
+    if elevenlabs_http is None:
+        elevenlabs_http = make_http_client(
+            TTS_TIMEOUT,
+            base_url="https://api.elevenlabs.io/v1",
+            headers={"xi-api-key": os.getenv('ELEVENLABS_API_KEY') or ""}
+        )
+    return elevenlabs_http
+
+class ScratchSpace:
+    """Tracks the files the bot creates in a directory and deletes them in batches.
+    
+    Files are reference counted while they are being read, so releasing one that is
+    still in use only deletes it once the last reader is done. Deletions are queued
+    and carried out by a background thread, which also collects temp files left
+    behind by a crash."""
+    
+    TEMP_SUFFIX = '.tmp'
+    
+    def __init__(self, directory, sweep_interval, orphan_age):
+        self.directory = directory
+        self.sweep_interval = sweep_interval
+        self.orphan_age = orphan_age
+        self.refs = {}  # path -> readers
+        self.doomed = set()  # released paths, deleted once nobody reads them
+        self.temp = set()  # temp files being written right now
+        self.deleted = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.temp_ids = itertools.count()
+        self.closed = False
+        self.thread = None
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._sweep_loop, daemon=True, name='scratch-sweeper')
+            self.thread.start()
+    
+    def temp_path(self, path):
+        """A fresh temp file name next to path, so it can be renamed into place atomically"""
+        temp = f"{path}.{os.getpid()}-{next(self.temp_ids)}{self.TEMP_SUFFIX}"
+        with self.lock:
+            self.temp.add(temp)
+        return temp
+    
+    def commit(self, temp, path):
+        """Move a finished temp file into place, cancelling any pending delete of path"""
+        with self.lock:
+            self.doomed.discard(path)
+            self.temp.discard(temp)
+            os.replace(temp, path)
+    
+    def abandon(self, temp):
+        with self.lock:
+            self.temp.discard(temp)
+            self.doomed.add(temp)
+    
+    def acquire(self, path):
+        with self.lock:
+            self.refs[path] = self.refs.get(path, 0) + 1
+    
+    def release(self, path):
+        with self.lock:
+            if self.refs[path] <= 1:
+                del self.refs[path]
+            else:
+                self.refs[path] -= 1
+    
+    def keep(self, path):
+        """Cancel a pending delete of path, it is in use again"""
+        with self.lock:
+            self.doomed.discard(path)
+    
+    def discard(self, path):
+        """Queue path for deletion by the sweeper"""
+        with self.lock:
+            self.doomed.add(path)
+    
+    def sweep(self):
+        """Delete every released file nobody is reading, plus stale temp files"""
+        with self.lock:
+            # Held while unlinking, so a commit of the same path can't be deleted by a stale entry
+            batch = [path for path in self.doomed if path not in self.refs]
+            for path in batch + self._orphans():
+                try:
+                    os.unlink(path)
+                    self.deleted += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Error deleting scratch file {path}: {e}")
+                self.doomed.discard(path)
+    
+    def _orphans(self):
+        """Temp files older than orphan_age that no writer in this process owns"""
+        cutoff = time.time() - self.orphan_age
+        orphans = []
+        try:
+            for entry in os.scandir(self.directory):
+                if (entry.name.endswith(self.TEMP_SUFFIX) and entry.path not in self.temp
+                        and entry.stat().st_mtime < cutoff):
+                    orphans.append(entry.path)
+        except OSError:
+            pass
+        return orphans
+    
+    def _sweep_loop(self):
+        while not self.closed:
+            self.wakeup.wait(self.sweep_interval)
+            self.wakeup.clear()
+            self.sweep()
+    
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.sweep()
+
+class SpeechStore:
+    """Where generated speech is kept beyond this process's memory, shared by every
+    process that points at it. Backends implement these methods"""
+    
+    size = 0  # bytes stored, for metrics
+    
+    def get(self, key):
+        """Return the audio for key, or None"""
+        raise NotImplementedError
+    
+    def put(self, key, audio):
+        raise NotImplementedError
+    
+    def stats(self):
+        return {}
+    
+    def close(self):
+        pass
+
+class FileSpeechStore(SpeechStore):
+    """Speech saved as MP3 files in a directory, least recently used files are evicted
+    once the directory grows past max_bytes.
+    
+    Several processes can share the directory: files another process wrote are picked
+    up on a miss, and files it evicted are forgotten when reading them fails."""
+    
+    def __init__(self, directory, max_bytes, scratch):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.scratch = scratch  # owns deleting files and temp writes in directory
+        self.files = OrderedDict()  # key -> file size
+        self.size = 0
+        # Lookups and writes run in worker threads
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+        self.scratch.start()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+    
+    def _load_index(self):
+        """Pick up audio cached by a previous run, oldest first"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.mp3'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        with self.lock:
+            for _, key, size in sorted(entries):
+                self.files[key] = size
+                self.size += size
+            self._evict()
+        print(f"TTS cache: {len(self.files)} entries ({self.size} bytes) on disk")
+    
+    def get(self, key):
+        path = self._path(key)
+        with self.lock:
+            known = key in self.files
+        if not known and not os.path.exists(path):
+            return None
+        self.scratch.acquire(path)  # eviction waits until we're done reading
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+            os.utime(path)  # mtime is the LRU order across restarts and processes
+            with self.lock:
+                if key in self.files:
+                    self.files.move_to_end(key)
+                else:
+                    # Written by another process, or evicted by us but not deleted yet. Still
+                    # holding our reference, so the sweeper can't delete it before we keep it
+                    self.scratch.keep(path)
+                    self.files[key] = len(audio)
+                    self.size += len(audio)
+                    self._evict()
+        except OSError as e:
+            # A missing file was evicted by another process
+            if not isinstance(e, FileNotFoundError):
+                print(f"Error reading cached speech {key}: {e}")
+            with self.lock:
+                self._forget(key)
+            return None
+        finally:
+            self.scratch.release(path)
+        return audio
+    
+    def put(self, key, audio):
+        with self.lock:
+            if len(audio) > self.max_bytes or key in self.files:
+                return
+        # Write then rename so a crash never leaves a truncated entry behind,
+        # the sweeper collects temp files orphaned that way
+        temp_path = self.scratch.temp_path(self._path(key))
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(audio)
+            self.scratch.commit(temp_path, self._path(key))
+        except OSError as e:
+            print(f"Error caching speech on disk: {e}")
+            self.scratch.abandon(temp_path)
+            return
+        with self.lock:
+            if key not in self.files:
+                self.files[key] = len(audio)
+                self.size += len(audio)
+            self._evict()
+    
+    def _forget(self, key):
+        size = self.files.pop(key, None)
+        if size is not None:
+            self.size -= size
+    
+    def _evict(self):
+        while self.size > self.max_bytes and self.files:
+            key, size = self.files.popitem(last=False)
+            self.size -= size
+            self.scratch.discard(self._path(key))
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "disk_entries": len(self.files),
+                "disk_bytes": self.size,
+                "scratch_deleted": self.scratch.deleted,
+            }
+    
+    def close(self):
+        self.scratch.close()
+
+class TTSCache:
+    """Two tier LRU cache for generated speech, keyed by a hash of the TTS request.
+    
+    Recently used audio is kept in memory, in front of an optional SpeechStore that
+    holds everything else. The memory tier evicts the least recently used entries
+    once it grows past memory_bytes."""
+    
+    def __init__(self, memory_bytes, store=None):
+        self.memory_bytes = memory_bytes
+        self.store = store
+        self.memory = OrderedDict()  # key -> audio bytes
+        self.memory_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # Store lookups and writes run in worker threads
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(text, voice_id, settings, model):
+        request = json.dumps([text, voice_id, settings, model], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+    
+    @property
+    def disk_size(self):
+        return self.store.size if self.store else 0
+    
+    def get_from_memory(self, key):
+        with self.lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+            return audio
+    
+    def get(self, key):
+        """Look up audio in memory, then in the store. Returns None on a miss"""
+        audio = self.get_from_memory(key)
+        if audio is not None:
+            return audio
+        
+        audio = self.store.get(key) if self.store else None
+        with self.lock:
+            if audio is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._store_in_memory(key, audio)
+        return audio
+    
+    def put(self, key, audio):
+        with self.lock:
+            self._store_in_memory(key, audio)
+        if self.store:
+            self.store.put(key, audio)
+    
+    def _store_in_memory(self, key, audio):
+        if len(audio) > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = audio
+        self.memory_size += len(audio)
+        while self.memory_size > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+    
+    def stats(self):
+        with self.lock:
+            stats = {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_size,
+            }
+        if self.store:
+            stats.update(self.store.stats())
+        return stats
+    
+    def close(self):
+        if self.store:
+            self.store.close()
+
+def create_speech_store():
+    """The file store is shared by every process using the same TTS_CACHE_DIR"""
+    if TTS_CACHE_DISK_MB <= 0:
+        return None
+    try:
+        scratch = ScratchSpace(TTS_CACHE_DIR, SCRATCH_SWEEP_SECONDS, SCRATCH_ORPHAN_SECONDS)
+        return FileSpeechStore(TTS_CACHE_DIR, int(TTS_CACHE_DISK_MB * 1024 * 1024), scratch)
+    except OSError as e:
+        print(f"TTS cache disk tier disabled: {e}")
+        return None
+
+def get_tts_cache():
+    """Build the speech cache on first use. Indexing a big disk cache is slow,
+    so this runs in disk_executor rather than on the event loop"""
+    global tts_cache
+    with tts_cache_lock:
+        if tts_cache is None:
+            cache = TTSCache(int(TTS_CACHE_MEMORY_MB * 1024 * 1024), create_speech_store())
+            atexit.register(cache.close)
+            tts_cache = cache
+        return tts_cache
+
+Counter("waifu_tts_cache_hits_total", "Speech cache hits by tier", function=lambda: {
+    (("tier", "memory"),): tts_cache.hits,
+    (("tier", "disk"),): tts_cache.disk_hits,
+} if tts_cache else {})
+Counter("waifu_tts_cache_misses_total", "Speech cache misses", function=lambda: tts_cache.misses if tts_cache else 0)
+Gauge("waifu_tts_cache_bytes", "Bytes of speech cached by tier", function=lambda: {
+    (("tier", "memory"),): tts_cache.memory_size,
+    (("tier", "disk"),): tts_cache.disk_size,
+} if tts_cache else {})
+
+def split_speech(text, max_chars=TTS_CHUNK_CHARS, first_alone=True):
+    """Split text into chunks of whole sentences of at most max_chars, to synthesize in parallel.
+    
+    With first_alone the first chunk stops growing once it has TTS_MIN_CHARS, so playback can
+    start as soon as possible, sentences longer than max_chars are split between words."""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        sentences.append(text[start:match.end()].strip())
+        start = match.end()
+    sentences.append(text[start:].strip())
+    
+    chunks = []
+    for sentence in filter(None, sentences):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            chunks.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        first_done = first_alone and len(chunks) == 1 and len(chunks[0]) >= TTS_MIN_CHARS
+        if chunks and not first_done and len(chunks[-1]) + 1 + len(sentence) <= max_chars:
+            chunks[-1] += " " + sentence
+        elif sentence:
+            chunks.append(sentence)
+    return chunks
+
+class Synthesizer:
+    """A speech engine. synthesize() returns audio in any format ffmpeg can decode.
+    
+    Callers hold one of the engine's slots (a semaphore) while it synthesizes."""
+    name = None
+    slots = None
+    
+    def cache_key(self, text):
+        raise NotImplementedError
+    
+    def available(self):
+        """Whether it is worth asking this engine right now"""
+        return True
+    
+    async def synthesize(self, text):
+        raise NotImplementedError
+
+class ElevenLabsSynthesizer(Synthesizer):
+    """The ElevenLabs API, returns MP3"""
+    name = "elevenlabs"
+    
+    def __init__(self):
+        self.breaker = elevenlabs_breaker
+        self.slots = tts_semaphore
+        self.exhausted_until = 0  # set when the account runs out of characters
+    
+    def cache_key(self, text):
+        return TTSCache.make_key(text, VOICE_ID, VOICE_SETTINGS, TTS_MODEL)
+    
+    def available(self):
+        return time.monotonic() >= self.exhausted_until and not self.breaker.is_open()
+    
+    async def synthesize(self, text):
+        if time.monotonic() < self.exhausted_until:
+            raise ServiceUnavailable("ElevenLabs is out of quota")
+        try:
+            audio = await self.breaker.call(lambda: request_speech(text), TTS_TIMEOUT)
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code in (401, 402) and 'quota' in response.text.lower():
+                print(f"ElevenLabs quota exceeded, not calling it for {TTS_QUOTA_BACKOFF:.0f}s")
+                self.exhausted_until = time.monotonic() + TTS_QUOTA_BACKOFF
+            raise
+        if not audio:
+            raise Exception("ElevenLabs returned no audio")
+        return audio
+
+class LocalSynthesizer(Synthesizer):
+    """A text to speech program on this machine, like espeak-ng or piper, run once per text.
+    
+    It reads the text on stdin and writes audio (like WAV) to stdout. It runs on the CPU,
+    so there are only `workers` slots."""
+    name = "local"
+    
+    def __init__(self, command, workers):
+        self.command = shlex.split(command)
+        self.slots = asyncio.Semaphore(max(1, workers))
+        self.installed = bool(self.command) and shutil.which(self.command[0]) is not None
+    
+    def cache_key(self, text):
+        return TTSCache.make_key(text, "local", self.command, None)
+    
+    def available(self):
+        return self.installed
+    
+    async def synthesize(self, text):
+        if not self.installed:
+            raise Exception(f"{self.command[0] if self.command else 'LOCAL_TTS_COMMAND'} is not installed")
+        
+        process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            audio, error = await asyncio.wait_for(process.communicate(text.encode('utf-8')), TTS_TIMEOUT)
+        except BaseException:
+            # Timed out or cancelled, don't leave the process running
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        
+        if process.returncode != 0:
+            message = error.decode('utf-8', errors='replace').strip()[-200:]
+            raise Exception(f"{self.command[0]} exited with {process.returncode}: {message}")
+        if not audio:
+            raise Exception(f"{self.command[0]} returned no audio")
+        return audio
+
+elevenlabs_synthesizer = ElevenLabsSynthesizer()
+local_synthesizer = LocalSynthesizer(LOCAL_TTS_COMMAND, LOCAL_TTS_WORKERS)
+synthesizers = {synthesizer.name: synthesizer for synthesizer in (elevenlabs_synthesizer, local_synthesizer)}
+
+# Engine picked per guild with w-tts, the others use TTS_BACKEND
+guild_synthesizers = {}
+
+def synthesizer_for(guild_id=None):
+    name = guild_synthesizers.get(guild_id, TTS_BACKEND)
+    return synthesizers.get(name, elevenlabs_synthesizer)
+
+def speech_cache_key(text, guild_id=None):
+    return synthesizer_for(guild_id).cache_key(text)
+
+async def request_speech(text):
+    """Call the ElevenLabs text to speech API, returns MP3 bytes"""
+    response = await get_elevenlabs_http().post(
+        f"/text-to-speech/{VOICE_ID}",
+        params={"output_format": "mp3_44100_128"},
+        headers={"Accept": "audio/mpeg"},
+        json={"text": text, "model_id": TTS_MODEL, "voice_settings": VOICE_SETTINGS}
+    )
+    response.raise_for_status()
+    return response.content
+
+async def synthesize(synthesizer, text, deadline=None):
+    """Synthesize once a slot is free. Waiting for the slot doesn't count toward the deadline
+    or the synthesis time, a busy engine isn't a slow one"""
+    async with synthesizer.slots:
+        with TTS_SYNTHESIS.time(backend=synthesizer.name):
+            return await asyncio.wait_for(synthesizer.synthesize(text), deadline)
+
+async def synthesize_with_fallback(primary, fallback, text):
+    """Synthesize with primary, or with fallback if primary fails or takes longer than
+    TTS_FALLBACK_AFTER. Returns the synthesizer that made the audio and the audio"""
+    if fallback is None:
+        return primary, await synthesize(primary, text)
+    
+    try:
+        return primary, await synthesize(primary, text, TTS_FALLBACK_AFTER)
+    except asyncio.TimeoutError:
+        reason = "slow"
+        print(f"Speech from {primary.name} is taking over {TTS_FALLBACK_AFTER:g}s, using {fallback.name}")
+    except Exception as e:
+        reason = "error"
+        print(f"Error generating speech with {primary.name}, using {fallback.name}: {e}")
+    TTS_FALLBACKS.inc(reason=reason)
+    return fallback, await synthesize(fallback, text)
+
+async def cached_speech(cache, cache_key):
+    # Audio cached in memory can be played right away
+    audio = cache.get_from_memory(cache_key)
+    if audio is None:
+        audio = await asyncio.get_running_loop().run_in_executor(disk_executor, cache.get, cache_key)
+        if audio is not None:
+            print(f"Speech cache hit ({len(audio)} bytes)")
+    return audio
+
+async def generate_speech(text, guild_id=None):
+    """Generate speech from text with the guild's speech engine, returns the audio bytes or None on failure"""
+    synthesizer = synthesizer_for(guild_id)
+    fallback = None
+    if TTS_FALLBACK and synthesizer is not local_synthesizer and local_synthesizer.available():
+        fallback = local_synthesizer
+    
+    loop = asyncio.get_running_loop()
+    cache = tts_cache or await loop.run_in_executor(disk_executor, get_tts_cache)
+    # A cache hit costs no quota, so the guild's own engine is checked even while it's unavailable
+    audio = await cached_speech(cache, synthesizer.cache_key(text))
+    if audio is not None:
+        return audio
+    
+    if fallback is not None and not synthesizer.available():
+        # Out of quota or paused by the breaker, skip straight to the local engine
+        TTS_FALLBACKS.inc(reason="unavailable")
+        synthesizer, fallback = fallback, None
+        audio = await cached_speech(cache, synthesizer.cache_key(text))
+        if audio is not None:
+            return audio
+    
+    try:
+        synthesizer, audio = await synthesize_with_fallback(synthesizer, fallback, text)
+        
+        print(f"Speech generated successfully with {synthesizer.name} ({len(audio)} bytes)")
+        # Cached under the engine that made it, so a fallback clip never stands in for the real voice later
+        loop.run_in_executor(disk_executor, cache.put, synthesizer.cache_key(text), audio)
+        return audio
+        
+    except Exception as e:
+        print(f"Error generating speech with {synthesizer.name}: {e}")
+        ERRORS.inc(stage="tts")
+        return None
+
+def speech_audio_source(audio):
+    """Create a Discord audio source that decodes TTS audio straight from memory.
+    
+    ffmpeg reads the bytes through a pipe and outputs 48kHz stereo PCM for Discord,
+    applying the volume boost in the same pass."""
+    return discord.FFmpegPCMAudio(
+        io.BytesIO(audio),
+        pipe=True,
+        options=f"-filter:a volume={SPEECH_GAIN_DB}dB"
+    )
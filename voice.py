@@ -0,0 +1,347 @@
+"""Per guild voice connections with a prioritized playback queue"""
+import asyncio
+import contextlib
+import functools
+import itertools
+import threading
+import time
+from collections import deque
+
+import discord
+
+from config import PRIORITY_NORMAL, TTS_PREFETCH, VOICE_IDLE_TIMEOUT
+from metrics import ERRORS, PLAYBACK_START, SPEECH_UNDERRUN, TRANSCODE_START, VOICE_CONNECT, Gauge
+from tasks import spawn
+from tts import generate_speech, speech_audio_source, split_speech
+
+async def play_and_wait(vc, audio_source):
+    """Play an audio source and wait until playback has finished"""
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    
+    def after_playing(error):
+        if error:
+            print(f'Error playing audio: {error}')
+        loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+    
+    vc.play(audio_source, after=after_playing)
+    await finished
+
+class TimedAudioSource(discord.AudioSource):
+    """Wraps an audio source and calls on_first_frame once audio starts coming out of it"""
+    
+    def __init__(self, source, on_first_frame):
+        self.source = source
+        self.on_first_frame = on_first_frame
+    
+    def read(self):
+        data = self.source.read()
+        if self.on_first_frame and data:
+            # Runs in the voice player thread, metrics are thread safe
+            self.on_first_frame()
+            self.on_first_frame = None
+        return data
+    
+    def is_opus(self):
+        return self.source.is_opus()
+    
+    def cleanup(self):
+        self.source.cleanup()
+
+class SpeechStream(discord.AudioSource):
+    """Plays audio sources back to back as one continuous stream, so there is no gap
+    or new ffmpeg start between the chunks of a reply.
+    
+    While waiting for the next chunk it plays silence, and it ends once close() has been
+    called and everything queued has played. Sources are cleaned up as soon as they
+    finish, so chunks that have been played don't stay in memory."""
+    
+    SILENCE = bytes(3840)  # 20ms of 48kHz 16-bit stereo PCM
+    
+    def __init__(self):
+        # Appended to on the event loop, read from the voice player thread
+        self.sources = deque()  # (source, on_finished)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.stopped = False
+    
+    def append(self, source, on_finished=None):
+        with self.lock:
+            if not self.stopped:
+                self.sources.append((source, on_finished))
+                return
+        source.cleanup()
+        if on_finished:
+            on_finished()
+    
+    def close(self):
+        """No more sources will be added"""
+        with self.lock:
+            self.closed = True
+    
+    def stop(self):
+        """End the stream without playing what is left"""
+        with self.lock:
+            self.stopped = True
+    
+    def read(self):
+        while True:
+            with self.lock:
+                if self.stopped:
+                    return b''
+                if not self.sources:
+                    if self.closed:
+                        return b''
+                    SPEECH_UNDERRUN.inc(0.02)
+                    return self.SILENCE
+                source, on_finished = self.sources[0]
+            data = source.read()
+            if data:
+                return data
+            with self.lock:
+                self.sources.popleft()
+            source.cleanup()
+            if on_finished:
+                on_finished()
+    
+    def is_opus(self):
+        return False
+    
+    def cleanup(self):
+        with self.lock:
+            self.stopped = True
+            sources, self.sources = self.sources, deque()
+        for source, on_finished in sources:
+            source.cleanup()
+            if on_finished:
+                on_finished()
+
+class Utterance:
+    """A reply to speak in a voice channel, made of audio clips played back in order.
+    
+    Clips are synthesized ahead of playback, at most TTS_PREFETCH at a time, and played
+    gaplessly through one SpeechStream. Long text is split into chunks so speaking can
+    start before the whole reply has been synthesized."""
+    
+    def __init__(self, channel, priority=PRIORITY_NORMAL, started=None):
+        self.channel = channel
+        self.priority = priority
+        self.started = started or time.monotonic()  # when the user asked, for the playback start metric
+        self.spoken = False
+        self.clips = asyncio.Queue()
+        self.ahead = asyncio.Semaphore(TTS_PREFETCH)  # clips synthesized but not played yet
+        self.stream = None
+        self.loop = None
+        self.cancelled = False
+        self.has_text = False  # only the very first chunk of a reply is spoken on its own
+    
+    def add(self, text):
+        chunks = split_speech(text, first_alone=not self.has_text)
+        self.has_text = self.has_text or bool(chunks)
+        for chunk in chunks:
+            self._add_clip(functools.partial(generate_speech, chunk, self.channel.guild.id))
+    
+    def add_audio(self, audio):
+        self._add_clip(functools.partial(asyncio.sleep, 0, audio))
+    
+    def _add_clip(self, make_audio):
+        if not self.cancelled:
+            self.clips.put_nowait(spawn(self._prefetch(make_audio)))
+    
+    async def _prefetch(self, make_audio):
+        # Bounded, so a long reply doesn't synthesize (and hold) all of its audio up front
+        await self.ahead.acquire()
+        return await make_audio()
+    
+    def close(self):
+        """No more clips will be added"""
+        self.clips.put_nowait(None)
+    
+    def cancel(self):
+        """Stop synthesizing clips that haven't been played"""
+        self.cancelled = True
+        while not self.clips.empty():
+            clip = self.clips.get_nowait()
+            if clip is not None:
+                clip.cancel()
+        if self.stream:
+            self.stream.stop()
+        # Wake up play() if it is waiting for the next clip
+        self.clips.put_nowait(None)
+    
+    def _played(self):
+        """Called from the voice player thread when a clip is done, to let the next one synthesize"""
+        with contextlib.suppress(RuntimeError):  # the loop is already closed at shutdown
+            self.loop.call_soon_threadsafe(self.ahead.release)
+    
+    async def play(self, vc):
+        self.loop = asyncio.get_running_loop()
+        playing = None
+        try:
+            while not self.cancelled:
+                clip = await self.clips.get()
+                if clip is None:
+                    break
+                try:
+                    audio = await clip
+                except asyncio.CancelledError:
+                    if clip.cancelled():
+                        continue
+                    raise
+                if not audio:
+                    print("Failed to generate speech")
+                    self.ahead.release()
+                    continue
+                if not vc.is_connected():
+                    print("Voice client disconnected before playing audio")
+                    self.cancel()
+                    break
+                if playing is None:
+                    self.stream = SpeechStream()
+                    self.stream.append(self._timed_source(audio), self._played)
+                    playing = spawn(play_and_wait(vc, self.stream))
+                elif playing.done():
+                    # Playback was stopped or failed, don't queue audio nobody will play
+                    self.cancel()
+                    break
+                else:
+                    self.stream.append(speech_audio_source(audio), self._played)
+        finally:
+            if self.stream:
+                self.stream.close()
+        if playing:
+            try:
+                await playing
+            except Exception as e:
+                print(f"Error playing audio: {e}")
+                self.stream.cleanup()
+    
+    def _timed_source(self, audio):
+        decode_started = time.monotonic()
+        
+        def on_first_frame():
+            now = time.monotonic()
+            TRANSCODE_START.observe(now - decode_started)
+            if not self.spoken:
+                self.spoken = True
+                PLAYBACK_START.observe(now - self.started)
+        
+        return TimedAudioSource(speech_audio_source(audio), on_first_frame)
+
+class VoiceSession:
+    """The bot's voice connection in one guild and the queue of utterances to play there"""
+    
+    def __init__(self, manager, guild):
+        self.manager = manager
+        self.guild = guild
+        self.queue = asyncio.PriorityQueue()  # (priority, sequence, Utterance)
+        self.current = None
+        self.closed = False
+        self.player = spawn(self._play_queue())
+    
+    def enqueue(self, utterance):
+        self.queue.put_nowait((utterance.priority, next(self.manager.sequence), utterance))
+    
+    async def connect(self, channel):
+        """Return a voice client in channel, reusing or moving the existing connection"""
+        vc = self.guild.voice_client
+        if vc and vc.is_connected():
+            if vc.channel != channel:
+                with VOICE_CONNECT.time(action="move"):
+                    await vc.move_to(channel)
+            return vc
+        if vc:
+            # Left over from a dropped connection
+            await vc.disconnect(force=True)
+        
+        # Connect to voice channel with retry logic
+        retries = 3
+        for attempt in range(retries):
+            try:
+                with VOICE_CONNECT.time(action="connect"):
+                    return await channel.connect(timeout=20, reconnect=True)
+            except (discord.ClientException, asyncio.TimeoutError, discord.errors.ConnectionClosed) as e:
+                if attempt == retries - 1:
+                    raise
+                print(f"Connection attempt {attempt + 1} failed: {e}")
+                await asyncio.sleep(1)
+    
+    async def _play_queue(self):
+        while not self.closed:
+            try:
+                _, _, utterance = await asyncio.wait_for(self.queue.get(), timeout=VOICE_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if self.queue.empty():
+                    print(f"Leaving voice in {self.guild.name} after {VOICE_IDLE_TIMEOUT:.0f}s idle")
+                    await self.manager.close(self.guild)
+                continue
+            if utterance is None:
+                continue
+            self.current = utterance
+            try:
+                vc = await self.connect(utterance.channel)
+                await utterance.play(vc)
+            except (discord.ClientException, asyncio.TimeoutError, discord.errors.ConnectionClosed) as e:
+                print(f"Voice connection failed, replying with text only: {e}")
+                ERRORS.inc(stage="voice")
+                utterance.cancel()
+            except Exception as e:
+                print(f"Error in voice session for {self.guild.name}: {e}")
+                utterance.cancel()
+            finally:
+                self.current = None
+    
+    def stop(self):
+        """Drop everything and end the player"""
+        self.closed = True
+        self.cancel_all()
+        self.queue.put_nowait((-1, next(self.manager.sequence), None))
+    
+    def cancel_all(self):
+        """Drop everything queued and stop what is playing"""
+        while not self.queue.empty():
+            _, _, utterance = self.queue.get_nowait()
+            utterance.cancel()
+        if self.current:
+            self.current.cancel()
+        vc = self.guild.voice_client
+        if vc and vc.is_playing():
+            vc.stop()
+
+class VoiceSessionManager:
+    """Keeps one VoiceSession per guild and tears down sessions that go idle"""
+    
+    def __init__(self):
+        self.sessions = {}  # guild id -> VoiceSession
+        self.sequence = itertools.count()  # keeps FIFO order within a priority
+        self.leaving = set()  # guilds we are disconnecting from on purpose
+    
+    def speak(self, guild, utterance):
+        """Queue an utterance for playback in the guild"""
+        session = self.sessions.get(guild.id)
+        if session is None or session.closed:
+            session = self.sessions[guild.id] = VoiceSession(self, guild)
+        session.enqueue(utterance)
+    
+    def expected_disconnect(self, guild_id):
+        if guild_id in self.leaving:
+            self.leaving.discard(guild_id)
+            return True
+        return False
+    
+    async def close(self, guild):
+        """Stop playback and leave voice in the guild"""
+        session = self.sessions.pop(guild.id, None)
+        if session:
+            session.stop()
+        vc = guild.voice_client
+        if vc:
+            self.leaving.add(guild.id)
+            await vc.disconnect(force=True)
+    
+    def active_sessions(self):
+        return len(self.sessions)
+
+voice_sessions = VoiceSessionManager()
+
+Gauge("waifu_voice_sessions_active", "Guilds with an active voice session", function=lambda: voice_sessions.active_sessions())
@@ -0,0 +1,150 @@
+"""Web server for Render's health check, metrics and admin endpoints"""
+import asyncio
+import contextlib
+import hmac
+import json
+import math
+
+from config import ADMIN_TOKEN, HEALTH_MAX_LAG, MAX_REQUEST_HEAD, PORT, WEB_MAX_CONNECTIONS, WEB_REQUEST_TIMEOUT
+from metrics import EVENT_LOOP_LAG, render_metrics, startup
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+                405: "Method Not Allowed", 408: "Request Timeout", 503: "Service Unavailable"}
+
+def json_response(code, data):
+    return code, 'application/json', json.dumps(data).encode('utf-8')
+
+async def handle_index(headers):
+    return 200, 'text/html', b'Waifu.exe Discord bot is running!'
+
+async def handle_metrics(headers):
+    return 200, 'text/plain; version=0.0.4', render_metrics().encode('utf-8')
+
+def gateway_status(gateway):
+    """Whether every shard's websocket is open right now, and their average heartbeat latency.
+    
+    is_ready() stays True while shards reconnect, so the websockets are checked directly."""
+    if gateway is None or not gateway.is_ready() or gateway.is_closed():
+        return False, None
+    shards = list(gateway.shards.values())
+    if not shards or any(shard.is_closed() for shard in shards):
+        return False, None
+    latencies = [shard.latency for shard in shards if math.isfinite(shard.latency)]
+    return True, sum(latencies) / len(latencies) if latencies else None
+
+def health_status(gateway):
+    """Whether the bot is connected to Discord and responsive, for /healthz"""
+    lag = EVENT_LOOP_LAG.values.get((), 0.0)
+    connected, latency = gateway_status(gateway)
+    return {
+        "ok": connected and lag < HEALTH_MAX_LAG,
+        "gateway_connected": connected,
+        "gateway_latency": latency,
+        "event_loop_lag": lag,
+        "startup": startup.phases,
+    }
+
+async def handle_healthz(headers):
+    status = health_status(web_server.gateway)
+    return json_response(200 if status["ok"] else 503, status)
+
+WEB_ROUTES = {
+    '/': handle_index,
+    '/metrics': handle_metrics,
+    '/healthz': handle_healthz,
+}
+ADMIN_ROUTES = {}  # registered by the modules that own the data
+
+class WebServer:
+    """A small HTTP/1.1 server on asyncio streams. Every request is its own task,
+    so a slow client only holds its own connection until it times out.
+    
+    It only needs the standard library, so it can answer health checks before the
+    bot itself has been imported."""
+    
+    def __init__(self, port, request_timeout=WEB_REQUEST_TIMEOUT, max_connections=WEB_MAX_CONNECTIONS):
+        self.port = port
+        self.request_timeout = request_timeout
+        self.max_connections = max_connections
+        self.connections = 0
+        self.server = None
+        self.gateway = None  # the Discord client, once it's loaded
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, port=self.port)
+        print(f"Web server listening on port {self.port}")
+    
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+    
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        try:
+            if self.connections > self.max_connections:
+                await self.respond(writer, 'GET', 503, 'text/plain', b'Too many connections')
+                return
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.request_timeout)
+            except asyncio.TimeoutError:
+                await self.respond(writer, 'GET', 408, 'text/plain', b'Request timeout')
+                return
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                await self.respond(writer, 'GET', 400, 'text/plain', b'Bad request')
+                return
+            method, path, headers = self.parse_head(head)
+            if method is None:
+                await self.respond(writer, 'GET', 400, 'text/plain', b'Bad request')
+                return
+            code, content_type, body = await asyncio.wait_for(self.route(method, path, headers), self.request_timeout)
+            await self.respond(writer, method, code, content_type, body)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            print(f"Error handling web request: {e}")
+        finally:
+            self.connections -= 1
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+    
+    @staticmethod
+    def parse_head(head):
+        if len(head) > MAX_REQUEST_HEAD:
+            return None, None, None
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            return None, None, None
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        return parts[0], parts[1].split('?', 1)[0], headers
+    
+    async def route(self, method, path, headers):
+        if method not in ('GET', 'HEAD'):
+            return 405, 'text/plain', b'Method not allowed'
+        handler = WEB_ROUTES.get(path)
+        if handler is None and ADMIN_TOKEN and path in ADMIN_ROUTES:
+            # Constant time, so response timing doesn't leak how much of the token matched
+            supplied = headers.get('authorization', '').encode('utf-8')
+            if not hmac.compare_digest(supplied, f"Bearer {ADMIN_TOKEN}".encode('utf-8')):
+                return 401, 'text/plain', b'Unauthorized'
+            handler = ADMIN_ROUTES[path]
+        if handler is None:
+            return 404, 'text/plain', b'Not found'
+        return await handler(headers)
+    
+    async def respond(self, writer, method, code, content_type, body):
+        head = (f"HTTP/1.1 {code} {HTTP_REASONS.get(code, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n")
+        writer.write(head.encode('latin-1') + (b'' if method == 'HEAD' else body))
+        await asyncio.wait_for(writer.drain(), self.request_timeout)
+
+web_server = WebServer(PORT)